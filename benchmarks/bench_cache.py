@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк кэша антифлуда: старый SimpleCache против TTLCache.
+
+Запуск:  python benchmarks/bench_cache.py [--sizes 10000 100000] [--ops 200]
+
+Кэш заполняется N ключами (вне замера), затем выполняется серия операций в том же
+порядке, что и в антифлуде: проверка ключа, чтение, запись.
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot import TTLCache  # noqa: E402
+
+
+class LegacySimpleCache:
+    """Копия прежнего SimpleCache из bot.py для сравнения"""
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.cache = {}
+        self.timestamps = {}
+
+    def __contains__(self, key):
+        self._cleanup()
+        return key in self.cache
+
+    def __getitem__(self, key):
+        self._cleanup()
+        return self.cache.get(key, [])
+
+    def __setitem__(self, key, value):
+        self._cleanup()
+        self.cache[key] = value
+        self.timestamps[key] = time.time()
+
+    def _cleanup(self):
+        now = time.time()
+        expired = [k for k, ts in self.timestamps.items() if now - ts > self.ttl]
+        for k in expired:
+            del self.cache[k]
+            del self.timestamps[k]
+
+
+def fill(cache, keys, value):
+    """Заполняет кэш ключами. Старый кэш - напрямую: его __setitem__ на
+    каждой вставке обходит все метки времени, и заполнение шло бы O(n^2)"""
+    if isinstance(cache, LegacySimpleCache):
+        now = time.time()
+        for key in keys:
+            cache.cache[key] = list(value)
+            cache.timestamps[key] = now
+    else:
+        for key in keys:
+            cache[key] = list(value)
+    return cache
+
+
+def run(cache, keys, ops):
+    """Среднее время одной операции антифлуда; заполнение в замер не входит"""
+    sample = random.choices(keys, k=ops)
+    start = time.perf_counter()
+    for key in sample:
+        if key not in cache:
+            cache[key] = []
+        value = cache[key]
+        cache[key] = value
+    return (time.perf_counter() - start) / ops
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000])
+    parser.add_argument("--ops", type=int, default=200, help="операций на замер")
+    args = parser.parse_args()
+
+    print(f"{'ключей':>8} {'SimpleCache, мкс/оп':>22} {'TTLCache, мкс/оп':>18} {'ускорение':>10}")
+    for size in args.sizes:
+        keys = [(-1000000000000 - i % 500, i) for i in range(size)]
+        legacy = run(fill(LegacySimpleCache(maxsize=size, ttl=60), keys, [0.0]), keys, args.ops)
+        ttl_cache = fill(TTLCache(maxsize=size, ttl=60), keys, [0.0])
+        current = run(ttl_cache, keys, args.ops)
+        print(f"{size:>8} {legacy * 1e6:>22.2f} {current * 1e6:>18.2f} {legacy / current:>9.0f}x")
+        print(f"{'':>8} TTLCache.stats(): {ttl_cache.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк доступа к БД из цикла событий: синхронный Database против AsyncDatabase.
+
+Запуск:  python benchmarks/bench_db.py [--chats 50] [--ops 40]
+
+Несколько «чатов» одновременно выполняют типичную для обработчиков смесь
+запросов (предупреждение, подсчет предупреждений, статистика), а отдельная
+задача-зонд каждую миллисекунду замеряет, насколько опаздывает цикл событий.
+Задержка зонда - это то, сколько ждали бы обновления из других чатов.
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="bench_db_"))  # файлы bench_*.db создаются в текущей папке
+
+from bot import AsyncDatabase, Database  # noqa: E402
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def probe(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def chat_workload(call, chat_id, ops, latencies):
+    for i in range(ops):
+        start = time.perf_counter()
+        await call("add_warning", chat_id, i % 20, 1, "bench")
+        await call("get_warnings_count", chat_id, i % 20)
+        await call("update_user_stats", chat_id, i % 20, "user", "User")
+        await call("get_user_stats", chat_id, i % 20)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(mode, chats, ops):
+    database = Database(f"bench_{mode}.db")
+    adb = AsyncDatabase(database)
+
+    if mode == "sync":
+        async def call(name, *args):
+            result = getattr(database, name)(*args)
+            await asyncio.sleep(0)
+            return result
+    else:
+        async def call(name, *args):
+            return await getattr(adb, name)(*args)
+
+    latencies, lags = [], []
+    stop = asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(chat_workload(call, -100 - n, ops, latencies) for n in range(chats)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    adb.close()
+
+    return {
+        "ops/s": chats * ops * 4 / elapsed,
+        "op p50, мс": percentile(latencies, 0.5) * 1000,
+        "op p99, мс": percentile(latencies, 0.99) * 1000,
+        "лаг p50, мс": statistics.median(lags) * 1000 if lags else 0.0,
+        "лаг p99, мс": percentile(lags, 0.99) * 1000 if lags else 0.0,
+        "лаг max, мс": max(lags) * 1000 if lags else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--chats", type=int, default=50, help="одновременных чатов")
+    parser.add_argument("--ops", type=int, default=40, help="итераций на чат")
+    args = parser.parse_args()
+
+    results = {mode: asyncio.run(run(mode, args.chats, args.ops)) for mode in ("sync", "async")}
+    print(f"{'':>14} {'Database':>12} {'AsyncDatabase':>14}")
+    for metric in results["sync"]:
+        print(f"{metric:>14} {results['sync'][metric]:>12.2f} {results['async'][metric]:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Офлайн-нагрузочный тест обработчиков bot.py без Telegram и без сети.
+
+Запуск:  python benchmarks/loadtest.py [--updates 5000] [--chats 20] [--users 200]
+                                      [--badwords 1000] [--rate 0] [--webhook] ...
+
+Строит синтетические Update (сообщения, вступления, команды) и прогоняет
+их через handle_messages, handle_new_members и обработчики команд.
+Вместо Bot API подставляется FakeBot, который только записывает вызовы.
+В конце печатает пропускную способность, p50/p99 задержки обработчиков,
+число COMMIT в SQLite, вызовы API и пиковое потребление памяти.
+
+С --webhook поднимается настоящее приложение из build_application в режиме
+webhook на 127.0.0.1, обновления отправляются ему POST-запросами, как это
+делает Telegram, а Bot API подменяется FakeTelegramRequest.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.chdir(tempfile.mkdtemp(prefix="loadtest_"))  # init_storage() создает БД в текущей папке
+
+from telegram import Chat, ChatMemberOwner, Message, Update, User  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import bot  # noqa: E402
+
+BOT_ID = 1
+ADMIN_ID = 1000
+BASE_DATE = 1700000000
+WORDS = ("привет", "как", "дела", "сегодня", "чат", "новости", "погода", "бот",
+         "вопрос", "ответ", "спасибо", "отлично", "завтра", "встреча", "код")
+SPAM = "Заработок от {sum} рублей в день без вложений! Пишите в личку @money_bot, {tail}"
+SPAM_TAILS = ("только сегодня бонус", "только сегодня бонус новым участникам", "бонус каждому 🔥", "места ограничены")
+
+
+class FakeBot:
+    """Заглушка Bot API: ничего не отправляет, только считает вызовы"""
+    defaults = None
+
+    def __init__(self, latency=0.0):
+        self.id = BOT_ID
+        self.username = "loadtest_bot"
+        self.latency = latency
+        self.calls = Counter()
+        self.message_ids = itertools.count(10 ** 9)
+
+    async def _record(self, method):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._record("send_message")
+        chat = Chat(chat_id, Chat.SUPERGROUP if chat_id < 0 else Chat.PRIVATE)
+        return Message(next(self.message_ids), datetime.now(), chat, text=text)
+
+    async def get_chat_administrators(self, chat_id, **kwargs):
+        await self._record("get_chat_administrators")
+        return (ChatMemberOwner(User(ADMIN_ID, "Admin", False), False),)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        async def method(*args, **kwargs):
+            await self._record(name)
+            return True
+        return method
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Транспорт Bot API без сети: отвечает на запросы так, как ответил бы Telegram"""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.message_ids = itertools.count(10 ** 9)
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _result(self, api_method, params):
+        if api_method == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Loadtest", "username": "loadtest_bot"}
+        if api_method == "sendMessage":
+            chat_id = int(params["chat_id"])
+            return {"message_id": next(self.message_ids), "date": int(time.time()), "text": params["text"],
+                    "chat": {"id": chat_id, "type": "supergroup" if chat_id < 0 else "private"}}
+        if api_method == "getChatAdministrators":
+            return [{"status": "creator", "is_anonymous": False,
+                     "user": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"}}]
+        return True
+
+    async def do_request(self, url, method, request_data=None, **timeouts):
+        api_method = url.rsplit("/", 1)[-1]
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+
+
+class UpdateFactory:
+    """Генератор синтетических обновлений в формате Bot API"""
+    def __init__(self, fake_bot, args, bad_words):
+        self.bot = fake_bot
+        self.args = args
+        self.bad_words = bad_words
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.chats = [-1001000000000 - n for n in range(args.chats)]
+        self.flooders = set(random.sample(range(args.users), min(args.flood_users, args.users)))
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"}
+
+    def _message(self, chat_id, user_id, **fields):
+        message = {
+            "message_id": next(self.message_ids),
+            "date": BASE_DATE,
+            "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+            "from": self._user(user_id),
+        }
+        message.update(fields)
+        return message
+
+    def _update(self, message):
+        return Update.de_json({"update_id": next(self.update_ids), "message": message}, self.bot)
+
+    def _text(self):
+        if random.random() < self.args.spam_ratio:
+            return SPAM.format(sum=random.choice((3000, 5000, 7000)), tail=random.choice(SPAM_TAILS))
+        words = random.choices(WORDS, k=random.randint(3, 15))
+        if self.bad_words and random.random() < self.args.badword_ratio:
+            words.insert(random.randrange(len(words)), random.choice(self.bad_words))
+        return " ".join(words)
+
+    def text_message(self, chat_id, user_id):
+        return self._update(self._message(chat_id, 10_000 + user_id, text=self._text()))
+
+    def new_members(self, chat_id):
+        members = [self._user(500_000 + next(self.message_ids)) for _ in range(random.randint(1, 3))]
+        return self._update(self._message(chat_id, members[0]["id"], new_chat_members=members))
+
+    def command(self, chat_id, name, user_id, text_args=(), reply_to_user=None):
+        fields = {"text": " ".join((f"/{name}",) + tuple(text_args)),
+                  "entities": [{"type": "bot_command", "offset": 0, "length": len(name) + 1}]}
+        if reply_to_user is not None:
+            fields["reply_to_message"] = self._message(chat_id, reply_to_user, text=self._text())
+        return self._update(self._message(chat_id, user_id, **fields))
+
+    def __iter__(self):
+        """Выдает (обработчик, update, аргументы команды)"""
+        commands = (
+            ("warn", bot.warn_command, ADMIN_ID, ["спам"]),
+            ("info", bot.info_command, None, []),
+            ("rules", bot.rules_command, None, []),
+            ("report", bot.report_command, None, []),
+        )
+        produced = 0
+        while produced < self.args.updates:
+            chat_id = random.choice(self.chats)
+            roll = random.random()
+            if roll < self.args.join_ratio:
+                yield bot.handle_new_members, self.new_members(chat_id), []
+                produced += 1
+            elif roll < self.args.join_ratio + self.args.command_ratio:
+                name, handler, user_id, command_args = random.choice(commands)
+                user_id = user_id or 10_000 + random.randrange(self.args.users)
+                target = 10_000 + random.randrange(self.args.users)
+                yield handler, self.command(chat_id, name, user_id, command_args, target), command_args
+                produced += 1
+            else:
+                user = random.randrange(self.args.users)
+                burst = self.args.flood_burst if user in self.flooders else 1
+                for _ in range(min(burst, self.args.updates - produced)):
+                    yield bot.handle_messages, self.text_message(chat_id, user), []
+                    produced += 1
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def run_webhook(args):
+    """Гоняет обновления через настоящий вебхук-сервер PTB, как Telegram"""
+    random.seed(args.seed)
+    bot.METRICS_PORT = 0
+    bot.UPDATE_WORKERS = args.workers
+    if not args.real_limits:
+        bot.outbox.global_limiter = bot.RateLimiter(10 ** 9)
+        bot.outbox.chat_rate = bot.outbox.chat_burst = 10 ** 9
+
+    request = FakeTelegramRequest(latency=args.api_latency / 1000)
+    application = bot.build_application("1:loadtest", request=request)
+    secret = "loadtest-secret"
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    await application.initialize()
+    await bot.on_startup(application)
+    await application.updater.start_webhook(
+        listen="127.0.0.1", port=port, url_path="telegram",
+        webhook_url=f"http://127.0.0.1:{port}/telegram", secret_token=secret,
+        max_connections=args.max_connections,
+        allowed_updates=bot.allowed_update_types(application),
+    )
+    await application.start()
+
+    bad_words = [f"плохоеслово{n}" for n in range(args.badwords)]
+    factory = UpdateFactory(application.bot, args, bad_words)
+    for chat_id in factory.chats:
+        if bad_words:
+            # update_bad_words меняет существующую строку chat_settings - создаем ее, как команда /addbadword
+            await bot.db.get_chat_settings(chat_id)
+            await bot.db.update_bad_words(chat_id, list(bad_words))
+
+    async def post(payload, token):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(
+            f"POST /telegram HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+            f"Content-Type: application/json\r\nContent-Length: {len(payload)}\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {token}\r\nConnection: close\r\n\r\n".encode() + payload
+        )
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        await reader.read()
+        writer.close()
+        return status
+
+    statuses = Counter()
+    latencies = []
+    semaphore = asyncio.Semaphore(args.max_connections)
+
+    async def deliver(update):
+        async with semaphore:
+            start = time.perf_counter()
+            statuses[await post(json.dumps(update.to_dict()).encode(), secret)] += 1
+            latencies.append(time.perf_counter() - start)
+
+    rejected = await post(b"{}", "wrong-secret")
+    started = time.perf_counter()
+    tasks = []
+    for n, (handler, update, command_args) in enumerate(factory):
+        if args.rate:
+            delay = started + n / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(deliver(update)))
+    await asyncio.gather(*tasks)
+
+    def handled():
+        return sum(value for (name, _), value in bot.metrics.counters.items() if name == "bot_handler_calls_total")
+    deadline = time.perf_counter() + 60
+    while handled() < args.updates and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    await application.updater.stop()
+    await application.stop()
+    await bot.on_shutdown(application)
+    await application.shutdown()
+
+    print(f"Обновлений: {handled():.0f} из {args.updates} за {elapsed:.2f} с -> {handled() / elapsed:.0f} обновлений/с")
+    print(f"Ответы вебхука: {dict(statuses)}; с неверным секретом: {rejected}")
+    print(f"POST p50/p99: {percentile(latencies, 0.5) * 1000:.2f}/{percentile(latencies, 0.99) * 1000:.2f} мс")
+    print(f"Запрашиваемые типы обновлений: {', '.join(bot.allowed_update_types(application))}")
+    print(f"Вызовы API: {dict(request.calls.most_common())}")
+    wait = [value for (name, _), value in bot.metrics.histograms.items() if name == "bot_update_wait_seconds"]
+    if wait:
+        print(f"Ожидание в очереди чата: среднее {wait[0][1] / max(wait[0][2], 1) * 1000:.2f} мс")
+    print(f"Пиковая память (RSS): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} МБ")
+
+
+async def run(args):
+    random.seed(args.seed)
+    fake_bot = FakeBot(latency=args.api_latency / 1000)
+    if args.real_limits:
+        bot.outbox.start(fake_bot)
+    else:
+        bot.outbox.bot = fake_bot  # outbox.send без очереди тоже идет через outbox.bot
+
+    commits = Counter()
+    bot.database.conn.set_trace_callback(lambda sql: sql == "COMMIT" and commits.update(("COMMIT",)))
+
+    bad_words = [f"плохоеслово{n}" for n in range(args.badwords)]
+    factory = UpdateFactory(fake_bot, args, bad_words)
+    for chat_id in factory.chats:
+        if bad_words:
+            # update_bad_words меняет существующую строку chat_settings - создаем ее, как команда /addbadword
+            bot.database.get_chat_settings(chat_id)
+            bot.database.update_bad_words(chat_id, list(bad_words))
+    commits.clear()
+
+    application = SimpleNamespace(create_task=asyncio.ensure_future, bot=fake_bot)
+    latencies = defaultdict(list)
+    errors = Counter()
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def process(handler, update, command_args):
+        context = SimpleNamespace(bot=fake_bot, args=list(command_args), application=application)
+        start = time.perf_counter()
+        try:
+            await handler(update, context)
+        except Exception as e:
+            errors[f"{handler.__name__}: {type(e).__name__}"] += 1
+        latencies[handler.__name__].append(time.perf_counter() - start)
+
+    async def limited(handler, update, command_args):
+        async with semaphore:
+            await process(handler, update, command_args)
+
+    tasks = []
+    started = time.perf_counter()
+    for n, (handler, update, command_args) in enumerate(factory):
+        if args.rate:
+            delay = started + n / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if args.concurrency > 1:
+            tasks.append(asyncio.ensure_future(limited(handler, update, command_args)))
+        else:
+            await process(handler, update, command_args)
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+
+    await bot.db.flush_user_stats()
+    if args.real_limits:
+        await bot.outbox.stop(timeout=60)
+
+    total = sum(len(values) for values in latencies.values())
+    print(f"Обновлений: {total} за {elapsed:.2f} с -> {total / elapsed:.0f} обновлений/с")
+    print(f"{'обработчик':>22} {'вызовов':>8} {'p50, мс':>9} {'p99, мс':>9} {'max, мс':>9}")
+    for name, values in sorted(latencies.items()):
+        print(f"{name:>22} {len(values):>8} {percentile(values, 0.5) * 1000:>9.3f} "
+              f"{percentile(values, 0.99) * 1000:>9.3f} {max(values) * 1000:>9.3f}")
+    print(f"COMMIT в SQLite: {commits['COMMIT']} ({commits['COMMIT'] * 1000 / max(total, 1):.1f} на 1000 обновлений)")
+    print(f"Вызовы API: {dict(fake_bot.calls.most_common())}")
+    print(f"Кэш настроек: {bot.database.settings_cache.stats()}")
+    print(f"Антифлуд: {bot.flood_limiter.stats()}")
+    verdicts = {dict(labels)["stage"]: value for (name, labels), value in bot.metrics.counters.items()
+                if name == "bot_filter_verdicts_total"}
+    for stage in bot.message_filters.stages:
+        _, spent, count = bot.metrics.histograms.get(("bot_filter_seconds", (("stage", stage.name),)), (None, 0.0, 0))
+        print(f"Фильтр {stage.name:>10}: проверок {count:>6}, среднее {spent / max(count, 1) * 1e6:>7.1f} мкс, "
+              f"вердиктов {verdicts.get(stage.name, 0):.0f}")
+    if errors:
+        print(f"Ошибки: {dict(errors)}")
+    print(f"Пиковая память (RSS): {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f} МБ")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--updates", type=int, default=5000, help="сколько обновлений прогнать")
+    parser.add_argument("--rate", type=float, default=0, help="темп, обновлений/с (0 - максимально быстро)")
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--users", type=int, default=200, help="пользователей в каждом чате")
+    parser.add_argument("--badwords", type=int, default=1000, help="размер списка запрещенных слов")
+    parser.add_argument("--badword-ratio", type=float, default=0.01, help="доля сообщений с запрещенным словом")
+    parser.add_argument("--spam-ratio", type=float, default=0.01, help="доля copy-paste спама с вариациями")
+    parser.add_argument("--flood-users", type=int, default=5, help="сколько пользователей флудят")
+    parser.add_argument("--flood-burst", type=int, default=10, help="сообщений подряд от флудера")
+    parser.add_argument("--join-ratio", type=float, default=0.02, help="доля событий вступления")
+    parser.add_argument("--command-ratio", type=float, default=0.02, help="доля команд")
+    parser.add_argument("--concurrency", type=int, default=1, help="обработчиков одновременно (1 - как в PTB по умолчанию)")
+    parser.add_argument("--api-latency", type=float, default=0, help="задержка каждого вызова API, мс")
+    parser.add_argument("--real-limits", action="store_true", help="пропускать вызовы через очередь отправки с лимитами Telegram")
+    parser.add_argument("--webhook", action="store_true", help="доставлять обновления через локальный вебхук")
+    parser.add_argument("--max-connections", type=int, default=40, help="одновременных POST к вебхуку")
+    parser.add_argument("--workers", type=int, default=bot.UPDATE_WORKERS,
+                        help="обработчиков обновлений в режиме --webhook (1 - последовательно)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser
+
+
+if __name__ == "__main__":
+    arguments = build_parser().parse_args()
+    bot.init_storage()
+    asyncio.run(run_webhook(arguments) if arguments.webhook else run(arguments))
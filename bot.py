@@ -6,28 +6,64 @@ Telegram Mod Bot - Единый файл (без cachetools)
 
 import os
 import re
+import sys
+import argparse
+import secrets
+import signal
+import queue
+import multiprocessing
 import sqlite3
 import json
+import gzip
+import hashlib
 import logging
 import asyncio
 import time
-from datetime import datetime, timedelta
-from collections import defaultdict
+import heapq
+import bisect
+import itertools
+import inspect
+import functools
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatPermissions
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, 
-    CallbackQueryHandler, filters, ContextTypes
+    CallbackQueryHandler, ChatMemberHandler, TypeHandler, BaseUpdateProcessor, filters, ContextTypes
 )
 from telegram.constants import ParseMode
+from telegram.error import RetryAfter, TelegramError
 
 # ==================== НАСТРОЙКИ ====================
-BOT_TOKEN = "8032712809:AAFcmS1G4xKURy2MZ9izAK8Ne8HXg8EIr8I"  # ВСТАВЬТЕ СВОЙ ТОКЕН СЮДА
+DEFAULT_BOT_TOKEN = "8032712809:AAFcmS1G4xKURy2MZ9izAK8Ne8HXg8EIr8I"
+BOT_TOKEN = os.environ.get('BOT_TOKEN', DEFAULT_BOT_TOKEN)  # ВСТАВЬТЕ СВОЙ ТОКЕН СЮДА или задайте BOT_TOKEN
+
+# Способ получения обновлений: "polling" или "webhook".
+# Значения берутся из переменных окружения и переопределяются аргументами
+# командной строки (python bot.py --help)
+BOT_MODE = os.environ.get('BOT_MODE', 'polling')
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL', '')  # полный публичный адрес, например https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')  # пусто - сгенерировать при запуске
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get('WEBHOOK_MAX_CONNECTIONS', 40))  # одновременных запросов от Telegram (1-100)
+
+# Шардирование: сколько процессов обрабатывают чаты (1 - все в одном процессе).
+# Чат всегда попадает в один и тот же процесс, там живет его состояние
+BOT_SHARDS = int(os.environ.get('BOT_SHARDS', 1))
+SHARD_RESTART_DELAY = 1  # через сколько секунд перезапускать упавший процесс
 
 # Настройки по умолчанию
 DEFAULT_WARN_LIMIT = 3
 DEFAULT_ANTIFLOOD_COUNT = 5
 DEFAULT_ANTIFLOOD_SECONDS = 10
+DEFAULT_JOIN_BURST_THRESHOLD = 5  # больше стольких вступлений за JOIN_RATE_WINDOW - одно общее приветствие
+DEFAULT_RAID_THRESHOLD = 30       # от стольких вступлений за JOIN_RATE_WINDOW - режим рейда (0 - выключен)
 DEFAULT_WELCOME_MESSAGE = "👋 Добро пожаловать, {name}!\nПожалуйста, ознакомься с правилами: /rules"
 DEFAULT_RULES = """📋 Правила чата:
 1. Уважайте друг друга
@@ -36,6 +72,121 @@ DEFAULT_RULES = """📋 Правила чата:
 4. Не рекламировать
 5. Администратор всегда прав 😉"""
 
+# Буфер статистики: сброс в БД, когда накопилось столько пар (чат, пользователь)
+# или прошло столько секунд с прошлого сброса
+STATS_FLUSH_SIZE = 500
+STATS_FLUSH_INTERVAL = 5
+
+# Сводки активности для /top и /chatstats: счетчики по часам, суткам,
+# неделям и месяцам (границы - по UTC). TOP_LIMIT - сколько строк в топе,
+# STATS_REPORT_TTL - сколько секунд отдавать отчет из кэша
+ROLLUP_PERIODS = ('hour', 'day', 'week', 'month')
+TOP_LIMIT = 10
+STATS_REPORT_TTL = 60
+
+# Сколько чатов держать в кэше настроек
+SETTINGS_CACHE_SIZE = 10000
+
+# Фильтр запрещенных слов: искать только целые слова (а не подстроки)
+# и нормализовать текст (регистр, ё/е, латиница и цифры вместо кириллицы)
+BADWORDS_WHOLE_WORDS = False
+BADWORDS_NORMALIZE = False
+
+# Похожие сообщения (copy-paste спам): если за DUPLICATE_WINDOW секунд
+# DUPLICATE_THRESHOLD разных пользователей прислали почти одинаковый текст,
+# эти сообщения удаляются ("delete") или только попадают в лог и метрики ("flag").
+# Отпечатки рассылки с другой суммой совпадают, с переписанной концовкой
+# отличаются на 9-15 бит, отпечатки несвязанных текстов - на 20 и больше
+DUPLICATE_THRESHOLD = 3        # 0 - не проверять
+DUPLICATE_WINDOW = 300
+DUPLICATE_MAX_PER_CHAT = 200   # сколько последних отпечатков помнить в каждом чате
+DUPLICATE_MAX_DISTANCE = 10    # сколько бит из 64 могут различаться у похожих текстов
+DUPLICATE_MIN_LENGTH = 30      # короткие сообщения ("привет", "+1") не проверяем
+DUPLICATE_ACTION = "delete"
+
+# Алгоритм антифлуда: "window" - скользящее окно, "bucket" - token bucket
+ANTIFLOOD_ALGORITHM = "window"
+
+# База данных: файл и число потоков/соединений для чтения
+DB_PATH = 'bot_database.db'
+DB_READ_CONNECTIONS = 4
+
+# Где хранить антифлуд, активные муты и кэш настроек: "memory" - в памяти
+# процесса, "sqlite" - в общем файле STATE_PATH (режим WAL). Общее состояние
+# видят все процессы бота на этой машине, и оно переживает перезапуск
+STATE_BACKEND = os.environ.get('STATE_BACKEND', 'memory')
+STATE_PATH = os.environ.get('STATE_PATH', 'bot_state.db')
+STATE_SETTINGS_TTL = 2  # сколько секунд процесс доверяет своей копии настроек из общего кэша
+
+# Сколько секунд доверять закэшированному списку админов чата
+ADMIN_CACHE_TTL = 600
+
+# Рассылки (жалобы админам и т.п.): сколько отправок одновременно
+FANOUT_CONCURRENCY = 10
+
+# Очередь исходящих запросов: лимиты Telegram - 30 сообщений/с на бота
+# и около 20 сообщений в минуту в одну группу
+OUTBOX_WORKERS = 8
+OUTBOX_GLOBAL_RATE = 30
+OUTBOX_CHAT_RATE = 20 / 60
+OUTBOX_CHAT_BURST = 10
+OUTBOX_MERGE_BACKLOG = 10  # с какой длины очереди склеивать уведомления в один чат
+OUTBOX_MAX_RETRIES = 3     # сколько раз повторять запрос после RetryAfter
+
+# Вступления: окно подсчета (сек), как часто отправлять общее приветствие
+# во время наплыва и сколько имен в нем перечислять
+JOIN_RATE_WINDOW = 60
+JOIN_SUMMARY_INTERVAL = 30
+JOIN_SUMMARY_NAMES = 20
+# Режим рейда: сколько длится после последнего всплеска и на сколько
+# ограничиваются вступившие за это время (сек)
+RAID_DURATION = 600
+RAID_RESTRICT_SECONDS = 3600
+
+# /clear: максимум сообщений за команду и сколько секунд висит отчет
+CLEAR_MAX_MESSAGES = 1000
+CLEAR_REPORT_SECONDS = 3
+
+# Как часто снимать истекшие муты (сек) и сколько строк удалять за транзакцию
+MUTE_EXPIRY_INTERVAL = 30
+MUTE_EXPIRY_BATCH = 500
+
+# Обслуживание БД: раз в MAINTENANCE_INTERVAL секунд устаревшие строки
+# удаляются пачками по MAINTENANCE_BATCH (между пачками - пауза, чтобы записи
+# обработчиков не ждали), затем файл сжимается (incremental_vacuum) и
+# обновляется статистика планировщика (ANALYZE). Сроки хранения - в днях, 0 - вечно
+MAINTENANCE_INTERVAL = 6 * 3600
+MAINTENANCE_BATCH = 500
+MAINTENANCE_PAUSE = 0.05
+MAINTENANCE_VACUUM_PAGES = 1000
+WARNINGS_RETENTION_DAYS = 180          # истекшие предупреждения перестают считаться
+INACTIVE_USER_RETENTION_DAYS = 365     # статистика тех, кто год ничего не писал
+HOURLY_ACTIVITY_RETENTION_DAYS = 14
+DAILY_ACTIVITY_RETENTION_DAYS = 400
+WEEKLY_ACTIVITY_RETENTION_DAYS = 730
+MONTHLY_ACTIVITY_RETENTION_DAYS = 1825
+# Куда дописывать удаленные строки (<таблица>-<время>.ndjson.gz); пусто - не сохранять
+MAINTENANCE_ARCHIVE_DIR = os.environ.get('MAINTENANCE_ARCHIVE_DIR', '')
+
+# Онлайн-копия БД: куда и как часто ее делать (пусто - не делать). Копируется
+# по BACKUP_PAGES страниц за шаг с паузой BACKUP_PAUSE, бот при этом работает
+BACKUP_PATH = os.environ.get('BACKUP_PATH', '')
+BACKUP_INTERVAL = 24 * 3600
+BACKUP_PAGES = 256
+BACKUP_PAUSE = 0.01
+# Выгрузка/загрузка чата (python bot.py export|import): строк в пачке
+EXPORT_BATCH = 1000
+
+# Параллельная обработка обновлений: сколько обработчиков работает одновременно
+# (обновления одного чата все равно идут по порядку; 1 - все по одному)
+# и сколько обновлений одного чата может ждать своей очереди (лишние отбрасываются)
+UPDATE_WORKERS = 32
+UPDATE_LANE_MAX_PENDING = 1000
+
+# Метрики в формате Prometheus: http://METRICS_HOST:METRICS_PORT/metrics (0 - выключено)
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9101
+
 # ==================== НАСТРОЙКА ЛОГИРОВАНИЯ ====================
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -43,132 +194,1092 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# ==================== ПРОСТОЙ КЭШ ДЛЯ АНТИФЛУДА (вместо cachetools) ====================
-class SimpleCache:
-    def __init__(self, maxsize=10000, ttl=60):
+# ==================== МЕТРИКИ ====================
+# Границы корзин гистограмм, сек: от долей миллисекунды (кэш, regex) до секунд (API)
+METRICS_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+METRIC_DESCRIPTIONS = {
+    'bot_handler_calls_total': ('counter', 'Вызовы обработчиков обновлений'),
+    'bot_handler_errors_total': ('counter', 'Исключения в обработчиках'),
+    'bot_handler_seconds': ('histogram', 'Время работы обработчика'),
+    'bot_db_seconds': ('histogram', 'Время выполнения метода Database'),
+    'bot_db_errors_total': ('counter', 'Исключения в методах Database'),
+    'bot_api_seconds': ('histogram', 'Время вызова Bot API'),
+    'bot_api_errors_total': ('counter', 'Ошибки вызовов Bot API'),
+    'bot_antiflood_triggers_total': ('counter', 'Срабатывания антифлуда'),
+    'bot_badword_triggers_total': ('counter', 'Найденные запрещенные слова'),
+    'bot_duplicate_triggers_total': ('counter', 'Сообщения, совпавшие с рассылкой от разных пользователей'),
+    'bot_filter_seconds': ('histogram', 'Время проверки сообщения этапом фильтра'),
+    'bot_filter_verdicts_total': ('counter', 'Сообщения, на которых этап фильтра остановил проверку'),
+    'bot_outbox_requests': ('gauge', 'Запросы в очереди отправки'),
+    'bot_settings_cache': ('gauge', 'Кэш настроек чатов'),
+    'bot_update_lanes': ('gauge', 'Очереди обновлений по чатам'),
+    'bot_update_wait_seconds': ('histogram', 'Ожидание обновления в очереди чата'),
+    'bot_updates_dropped_total': ('counter', 'Обновления, отброшенные из-за переполненной очереди чата'),
+    'bot_shard_updates_total': ('counter', 'Обновления, переданные процессу-шарду'),
+    'bot_shard_restarts_total': ('counter', 'Перезапуски упавших процессов-шардов'),
+    'bot_shard_queue': ('gauge', 'Обновления в очереди процесса-шарда'),
+    'bot_joins_total': ('counter', 'Вступившие в чаты участники'),
+    'bot_welcome_summaries_total': ('counter', 'Общие приветствия во время наплыва'),
+    'bot_raids_total': ('counter', 'Включения режима рейда'),
+    'bot_raid_restricted_total': ('counter', 'Участники, ограниченные в режиме рейда'),
+    'bot_maintenance_deleted_total': ('counter', 'Строки, удаленные обслуживанием БД'),
+}
+
+def format_labels(labels, extra=()):
+    pairs = tuple(labels) + tuple(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+def format_value(value):
+    """Значение метрики без потери точности: {:g} оставил бы 6 значащих цифр"""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+class Metrics:
+    """Счетчики, гистограммы и gauge'и с выдачей в текстовом формате Prometheus.
+    
+    Методы БД выполняются в пулах потоков, поэтому запись идет под блокировкой.
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.lock = threading.Lock()
+        self.counters = defaultdict(float)  # (имя, метки) -> значение
+        self.histograms = {}  # (имя, метки) -> [счетчики корзин, сумма, количество]
+        self.gauges = {}  # (имя, метки) -> функция
+    
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] += value
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][index] += 1
+            histogram[1] += value
+            histogram[2] += 1
+    
+    @contextmanager
+    def timer(self, name, errors=None, **labels):
+        """Замеряет время блока в гистограмму name; исключения считает в errors"""
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            if errors:
+                self.inc(errors, **labels)
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+    
+    def gauge(self, name, func, **labels):
+        """Регистрирует значение, которое вычисляется в момент выдачи метрик"""
+        self.gauges[(name, tuple(sorted(labels.items())))] = func
+    
+    def render(self):
+        with self.lock:
+            series = defaultdict(list)
+            for (name, labels), value in self.counters.items():
+                series[name].append(f"{name}{format_labels(labels)} {format_value(value)}")
+            for (name, labels), (counts, total, count) in self.histograms.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    series[name].append(f"{name}_bucket{format_labels(labels, [('le', f'{bound:g}')])} {cumulative}")
+                series[name].append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {count}")
+                series[name].append(f"{name}_sum{format_labels(labels)} {total:.6f}")
+                series[name].append(f"{name}_count{format_labels(labels)} {count}")
+        for (name, labels), func in self.gauges.items():
+            try:
+                series[name].append(f"{name}{format_labels(labels)} {format_value(func())}")
+            except Exception:
+                logger.exception("Не удалось вычислить метрику %s", name)
+        
+        lines = []
+        for name in sorted(series):
+            kind, description = METRIC_DESCRIPTIONS.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            lines.extend(series[name])
+        return '\n'.join(lines) + '\n'
+
+def instrumented(handler):
+    """Оборачивает обработчик: число вызовов, ошибок и гистограмма времени"""
+    name = handler.__name__
+    
+    @functools.wraps(handler)
+    async def wrapper(update, context):
+        metrics.inc('bot_handler_calls_total', handler=name)
+        with metrics.timer('bot_handler_seconds', errors='bot_handler_errors_total', handler=name):
+            return await handler(update, context)
+    return wrapper
+
+async def serve_metrics(reader, writer):
+    """Отвечает на GET /metrics; это минимальный HTTP, только для Prometheus"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 5)
+        while await asyncio.wait_for(reader.readline(), 5) not in (b'\r\n', b'\n', b''):
+            pass
+        
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', metrics.render().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+# ==================== КЭШ С ВРЕМЕНЕМ ЖИЗНИ (вместо cachetools) ====================
+class TTLCache:
+    """Кэш с временем жизни записей и жестким ограничением размера.
+    
+    Записи упорядочены по времени последней записи, поэтому просроченные
+    всегда лежат в начале и удаляются лениво за амортизированное O(1).
+    При переполнении вытесняется запись, которую дольше всех не обновляли.
+    """
+    def __init__(self, maxsize=10000, ttl=60, timer=time.monotonic):
         self.maxsize = maxsize
         self.ttl = ttl
-        self.cache = {}
-        self.timestamps = {}
+        self.timer = timer
+        self.data = OrderedDict()  # key -> (expires_at, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+    
+    def _expire(self, now):
+        data = self.data
+        while data:
+            expires_at, _ = data[next(iter(data))]
+            if expires_at > now:
+                break
+            data.popitem(last=False)
+            self.expirations += 1
     
     def __contains__(self, key):
-        self._cleanup()
-        return key in self.cache
+        self._expire(self.timer())
+        return key in self.data
     
     def __getitem__(self, key):
-        self._cleanup()
-        return self.cache.get(key, [])
+        value = self.get(key, self)
+        if value is self:
+            raise KeyError(key)
+        return value
+    
+    def get(self, key, default=None):
+        self._expire(self.timer())
+        entry = self.data.get(key)
+        if entry is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return entry[1]
     
     def __setitem__(self, key, value):
-        self._cleanup()
-        self.cache[key] = value
-        self.timestamps[key] = time.time()
+        now = self.timer()
+        self._expire(now)
+        data = self.data
+        data[key] = (now + self.ttl, value)
+        data.move_to_end(key)
+        while len(data) > self.maxsize:
+            data.popitem(last=False)
+            self.evictions += 1
+    
+    def __delitem__(self, key):
+        del self.data[key]
+    
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, None)
+        return default if entry is None else entry[1]
+    
+    def __len__(self):
+        self._expire(self.timer())
+        return len(self.data)
+    
+    def clear(self):
+        self.data.clear()
+    
+    def stats(self):
+        return {
+            'size': len(self),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+# ==================== АНТИФЛУД ====================
+class WindowState:
+    """Кольцевой буфер времен последних limit + 1 сообщений"""
+    __slots__ = ('times', 'pos', 'expires_at')
+    
+    def __init__(self, limit):
+        self.times = [float('-inf')] * (limit + 1)
+        self.pos = 0
+        self.expires_at = 0.0
+
+class BucketState:
+    """Ведро токенов: одно сообщение расходует один токен"""
+    __slots__ = ('tokens', 'updated_at', 'expires_at')
+    
+    def __init__(self, tokens, now):
+        self.tokens = tokens
+        self.updated_at = now
+        self.expires_at = 0.0
+
+class FloodLimiter:
+    """Антифлуд: не больше limit сообщений за seconds секунд от пользователя.
+    
+    Состояние пользователя - объект со __slots__, который переиспользуется
+    между сообщениями; проверка стоит O(1). Неактивные пользователи
+    вытесняются по ttl и по maxsize, как в TTLCache.
+    """
+    blocking = False  # см. ХРАНИЛИЩЕ СОСТОЯНИЯ
+    
+    def __init__(self, algorithm=ANTIFLOOD_ALGORITHM, maxsize=10000, ttl=60, timer=time.monotonic):
+        if algorithm not in ('window', 'bucket'):
+            raise ValueError(f"Неизвестный алгоритм антифлуда: {algorithm}")
+        self.algorithm = algorithm
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.states = OrderedDict()  # (chat_id, user_id) -> WindowState | BucketState
+        self.evictions = 0
+        self.expirations = 0
+        self._check = self._check_window if algorithm == 'window' else self._check_bucket
+    
+    def hit(self, chat_id, user_id, limit, seconds):
+        """Учитывает сообщение. Возвращает True, если лимит превышен"""
+        now = self.timer()
+        states = self.states
+        while states:
+            oldest = states[next(iter(states))]
+            if oldest.expires_at > now:
+                break
+            states.popitem(last=False)
+            self.expirations += 1
+        
+        key = (chat_id, user_id)
+        state = states.get(key)
+        flooded, state = self._check(state, now, limit, seconds)
+        # Состояние должно жить не меньше окна антифлуда
+        state.expires_at = now + max(self.ttl, seconds)
+        states[key] = state
+        states.move_to_end(key)
+        if len(states) > self.maxsize:
+            states.popitem(last=False)
+            self.evictions += 1
+        return flooded
+    
+    def _check_window(self, state, now, limit, seconds):
+        if state is None or len(state.times) != limit + 1:
+            state = WindowState(limit)
+        times = state.times
+        times[state.pos] = now
+        state.pos = (state.pos + 1) % len(times)
+        # Следующая ячейка кольца - сообщение, отправленное limit сообщений назад
+        return now - times[state.pos] <= seconds, state
+    
+    def _check_bucket(self, state, now, limit, seconds):
+        if state is None:
+            state = BucketState(limit, now)
+        else:
+            refill = (now - state.updated_at) * limit / seconds
+            state.tokens = min(limit, state.tokens + refill)
+            state.updated_at = now
+        if state.tokens >= 1:
+            state.tokens -= 1
+            return False, state
+        return True, state
+    
+    def stats(self):
+        return {
+            'size': len(self.states),
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+# ==================== ИНДЕКС МУТОВ ====================
+class MuteIndex:
+    """Активные муты в памяти: словарь для проверки и куча по времени окончания"""
+    blocking = False  # см. ХРАНИЛИЩЕ СОСТОЯНИЯ
     
-    def _cleanup(self):
-        now = time.time()
-        expired = [k for k, ts in self.timestamps.items() if now - ts > self.ttl]
-        for k in expired:
-            del self.cache[k]
-            del self.timestamps[k]
+    def __init__(self):
+        self.until = {}  # (chat_id, user_id) -> unix-время окончания мута
+        self.heap = []   # (время окончания, chat_id, user_id), устаревшие записи пропускаются
+        # Изменения идут из потока БД; is_muted - одно чтение словаря, без блокировки
+        self.lock = threading.Lock()
+    
+    def add(self, chat_id, user_id, until):
+        with self.lock:
+            self.until[(chat_id, user_id)] = until
+            heapq.heappush(self.heap, (until, chat_id, user_id))
+            # Перемуты и ручные размуты оставляют в куче мусор - периодически пересобираем
+            if len(self.heap) > 2 * len(self.until) + 1000:
+                self.heap = [(ts, chat_id, user_id) for (chat_id, user_id), ts in self.until.items()]
+                heapq.heapify(self.heap)
+    
+    def add_many(self, mutes):
+        """Добавляет пачку (chat_id, user_id, until) и один раз пересобирает кучу"""
+        with self.lock:
+            for chat_id, user_id, until in mutes:
+                self.until[(chat_id, user_id)] = until
+            self.heap = [(ts, chat_id, user_id) for (chat_id, user_id), ts in self.until.items()]
+            heapq.heapify(self.heap)
+    
+    def remove(self, chat_id, user_id):
+        with self.lock:
+            self.until.pop((chat_id, user_id), None)
+    
+    def is_muted(self, chat_id, user_id, now):
+        until = self.until.get((chat_id, user_id))
+        return until is not None and until > now
+    
+    def pop_expired(self, now, limit):
+        """Убирает из индекса до limit истекших мутов и возвращает их ключи"""
+        expired = []
+        with self.lock:
+            heap = self.heap
+            while heap and heap[0][0] <= now and len(expired) < limit:
+                until, chat_id, user_id = heapq.heappop(heap)
+                if self.until.get((chat_id, user_id)) == until:
+                    del self.until[(chat_id, user_id)]
+                    expired.append((chat_id, user_id))
+        return expired
+    
+    def __len__(self):
+        return len(self.until)
+
+# ==================== БУФЕР СТАТИСТИКИ ====================
+class StatsBuffer:
+    """Копит счетчики сообщений в памяти, чтобы писать их в БД пачкой.
+    
+    Запись на пару (чат, пользователь): [сообщений, первое, последнее,
+    username, имя, {начало часа: сообщений}]; время - time.time().
+    """
+    def __init__(self, max_pending=STATS_FLUSH_SIZE, flush_interval=STATS_FLUSH_INTERVAL):
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.last_flush = time.monotonic()
+        # Сообщения учитываются в цикле событий, а сброс идет в потоке БД
+        self.lock = threading.Lock()
+    
+    def add(self, chat_id, user_id, username, first_name, now):
+        """Учитывает сообщение. Возвращает True, если буфер пора сбросить"""
+        hour = int(now) // 3600 * 3600
+        with self.lock:
+            entry = self.pending.get((chat_id, user_id))
+            if entry is None:
+                self.pending[(chat_id, user_id)] = [1, now, now, username, first_name, {hour: 1}]
+            else:
+                entry[0] += 1
+                entry[2] = now
+                entry[3] = username
+                entry[4] = first_name
+                hours = entry[5]
+                hours[hour] = hours.get(hour, 0) + 1
+            return (len(self.pending) >= self.max_pending
+                    or time.monotonic() - self.last_flush >= self.flush_interval)
+    
+    def get(self, chat_id, user_id):
+        """(сообщений, первое, последнее) еще не сброшенных сообщений или None"""
+        with self.lock:
+            entry = self.pending.get((chat_id, user_id))
+            return tuple(entry[:3]) if entry else None
+    
+    def take(self):
+        """Забирает накопленные счетчики и очищает буфер"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            self.last_flush = time.monotonic()
+        return pending
+    
+    def restore(self, pending):
+        """Возвращает в буфер счетчики, которые не удалось записать"""
+        with self.lock:
+            for key, (count, first_seen, last_seen, username, first_name, hours) in pending.items():
+                entry = self.pending.get(key)
+                if entry is None:
+                    self.pending[key] = [count, first_seen, last_seen, username, first_name, hours]
+                else:
+                    entry[0] += count
+                    entry[1] = first_seen
+                    for hour, messages in hours.items():
+                        entry[5][hour] = entry[5].get(hour, 0) + messages
+
+@functools.lru_cache(maxsize=1024)
+def rollup_buckets(hour):
+    """Начала часа, суток, недели (с понедельника) и месяца, в которые попадает час"""
+    day = hour - hour % 86400
+    week = day - (day // 86400 + 3) % 7 * 86400  # 1 января 1970 - четверг
+    month = int(datetime.fromtimestamp(day, timezone.utc).replace(day=1).timestamp())
+    return tuple(zip(ROLLUP_PERIODS, (hour, day, week, month)))
+
+def current_bucket(period, now=None):
+    """Начало текущего часа/суток/недели/месяца"""
+    hour = int(time.time() if now is None else now) // 3600 * 3600
+    return dict(rollup_buckets(hour))[period]
+
+# ==================== КЭШ НАСТРОЕК ЧАТОВ ====================
+# Типы колонок chat_settings: SQLite отдает BOOLEAN как 0/1, приводим явно
+SETTINGS_TYPES = {
+    'chat_id': int,
+    'welcome_message': str,
+    'rules': str,
+    'warn_limit': int,
+    'antiflood_enabled': bool,
+    'antiflood_count': int,
+    'antiflood_seconds': int,
+    'bad_words': str,
+    'join_burst_threshold': int,
+    'raid_threshold': int,
+}
+
+def typed_settings(columns, row):
+    """Собирает словарь настроек из строки chat_settings с приведением типов"""
+    settings = {}
+    for column, value in zip(columns, row):
+        cast = SETTINGS_TYPES.get(column)
+        settings[column] = cast(value) if cast and value is not None else value
+    return settings
+
+class SettingsCache:
+    """LRU-кэш настроек чатов. Словари из кэша отдаются как есть - не изменяйте их"""
+    blocking = False  # см. ХРАНИЛИЩЕ СОСТОЯНИЯ
+    
+    def __init__(self, maxsize=SETTINGS_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def get(self, chat_id):
+        with self.lock:
+            settings = self.data.get(chat_id)
+            if settings is None:
+                self.misses += 1
+                return None
+            self.data.move_to_end(chat_id)
+            self.hits += 1
+            return settings
+    
+    def put(self, chat_id, settings):
+        with self.lock:
+            self.data[chat_id] = settings
+            self.data.move_to_end(chat_id)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+    
+    def put_many(self, items):
+        """Кладет пары (chat_id, настройки); последние в списке считаются самыми свежими"""
+        for chat_id, settings in items:
+            self.put(chat_id, settings)
+    
+    def update(self, chat_id, column, value):
+        """Обновляет поле, если чат в кэше (write-through после UPDATE в БД)"""
+        with self.lock:
+            settings = self.data.get(chat_id)
+            if settings is not None:
+                cast = SETTINGS_TYPES.get(column)
+                settings[column] = cast(value) if cast and value is not None else value
+    
+    def invalidate(self, chat_id):
+        with self.lock:
+            self.data.pop(chat_id, None)
+    
+    def stats(self):
+        return {
+            'size': len(self.data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+# ==================== ФИЛЬТР ЗАПРЕЩЕННЫХ СЛОВ ====================
+# Замены один символ -> один символ, чтобы позиции в тексте не сдвигались
+NORMALIZE_TABLE = str.maketrans({
+    'ё': 'е',
+    'a': 'а', 'b': 'в', 'c': 'с', 'e': 'е', 'h': 'н', 'k': 'к', 'm': 'м',
+    'o': 'о', 'p': 'р', 't': 'т', 'x': 'х', 'y': 'у',
+    '0': 'о', '3': 'з', '4': 'ч', '6': 'б', '@': 'а', '$': 'с',
+})
+
+def normalize_text(text):
+    """Приводит текст к виду, в котором сравниваются запрещенные слова"""
+    return text.lower().translate(NORMALIZE_TABLE)
+
+def build_trie_pattern(words):
+    """Собирает регулярку по префиксному дереву слов: один проход по тексту"""
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = True
+    
+    def node_pattern(node):
+        branches = [
+            re.escape(char) + node_pattern(child)
+            for char, child in sorted(node.items()) if char
+        ]
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        pattern = '(?:' + '|'.join(branches) + ')'
+        return pattern + '?' if '' in node else pattern
+    
+    return node_pattern(trie)
+
+class BadWordMatcher:
+    """Скомпилированный список запрещенных слов одного чата"""
+    def __init__(self, words, whole_words=BADWORDS_WHOLE_WORDS, normalize=BADWORDS_NORMALIZE):
+        self.normalize = normalize
+        prepare = normalize_text if normalize else str.lower
+        words = {prepare(word.strip()) for word in words}
+        words.discard('')
+        pattern = build_trie_pattern(words)
+        if whole_words:
+            pattern = r'(?<!\w)(?:' + pattern + r')(?!\w)'
+        self.regex = re.compile(pattern)
+    
+    def search(self, text):
+        """Возвращает первое найденное запрещенное слово или None"""
+        text = normalize_text(text) if self.normalize else text.lower()
+        match = self.regex.search(text)
+        return match.group() if match else None
+
+# ==================== ПОХОЖИЕ СООБЩЕНИЯ (SIMHASH) ====================
+SIMHASH_MASK = (1 << 64) - 1
+WORD_RE = re.compile(r'\w+')
+NUMBER_RE = re.compile(r'\d+')
+
+@functools.lru_cache(maxsize=65536)
+def feature_hash(feature):
+    """Стабильный 64-битный хэш признака: в отличие от hash(), одинаков во всех процессах и запусках"""
+    return int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), 'little')
+
+def simhash(text):
+    """64-битный simhash по словам и парам соседних слов нормализованного текста.
+    
+    Все числа заменяются одним и тем же токеном: в рассылках обычно меняют
+    сумму, телефон или дату, а одно слово с двумя парами вокруг него
+    сдвигает отпечаток на ~10 бит. Счетчики битов хранятся «вертикально»:
+    planes[i] - i-й разряд счетчиков всех 64 позиций сразу, так что признак
+    прибавляется парой операций над int, а не циклом по 64 битам.
+    """
+    # 9 не входит в NORMALIZE_TABLE и переживает нормализацию
+    words = WORD_RE.findall(normalize_text(NUMBER_RE.sub('9', text)))
+    features = set(words)
+    features.update(map(' '.join, zip(words, words[1:])))
+    planes = []
+    for item in features:
+        carry = feature_hash(item)
+        for i, plane in enumerate(planes):
+            planes[i] = plane ^ carry
+            carry &= plane
+            if not carry:
+                break
+        else:
+            planes.append(carry)
+    
+    # Бит отпечатка равен 1, если его выставили больше половины признаков
+    threshold = len(features) // 2
+    greater, equal = 0, SIMHASH_MASK
+    for i in range(max(len(planes), threshold.bit_length()) - 1, -1, -1):
+        plane = planes[i] if i < len(planes) else 0
+        if threshold >> i & 1:
+            equal &= plane
+        else:
+            greater |= equal & plane
+            equal &= ~plane
+    return greater
+
+class DuplicateDetector:
+    """Отпечатки последних сообщений каждого чата в окне window секунд.
+    
+    В чате помнится не больше max_per_chat сообщений, чаты без сообщений
+    за окно забываются. Запись - [время, отпечаток, user_id, message_id, удалено].
+    """
+    def __init__(self, window=DUPLICATE_WINDOW, max_per_chat=DUPLICATE_MAX_PER_CHAT,
+                 max_distance=DUPLICATE_MAX_DISTANCE, min_length=DUPLICATE_MIN_LENGTH,
+                 timer=time.monotonic):
+        self.window = window
+        self.max_per_chat = max_per_chat
+        self.max_distance = max_distance
+        self.min_length = min_length
+        self.timer = timer
+        self.chats = TTLCache(maxsize=SETTINGS_CACHE_SIZE, ttl=window, timer=timer)  # chat_id -> deque записей
+    
+    def check(self, chat_id, user_id, message_id, text):
+        """Запоминает сообщение и возвращает похожие на него записи (включая его самого)"""
+        if len(text) < self.min_length:
+            return []
+        fingerprint = simhash(text)
+        now = self.timer()
+        entries = self.chats.get(chat_id)
+        if entries is None:
+            entries = deque(maxlen=self.max_per_chat)
+        cutoff = now - self.window
+        while entries and entries[0][0] <= cutoff:
+            entries.popleft()
+        
+        max_distance = self.max_distance
+        similar = [entry for entry in entries if (entry[1] ^ fingerprint).bit_count() <= max_distance]
+        entry = [now, fingerprint, user_id, message_id, False]
+        entries.append(entry)
+        self.chats[chat_id] = entries
+        similar.append(entry)
+        return similar
+    
+    @staticmethod
+    def take_undeleted(entries):
+        """ID сообщений, которые еще не удаляли; помечает их удаленными"""
+        message_ids = [entry[3] for entry in entries if not entry[4]]
+        for entry in entries:
+            entry[4] = True
+        return message_ids
 
 # ==================== БАЗА ДАННЫХ (SQLite) ====================
+MISSING = object()
+
+# Настройки соединения: WAL, чтобы читатели из пула не ждали писателя;
+# synchronous=NORMAL в режиме WAL не рискует целостностью БД
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",     # 16 МБ
+    "PRAGMA mmap_size=268435456",   # 256 МБ
+)
+
+def apply_pragmas(conn):
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+
+# Миграции схемы: (версия, описание, SQL-запросы). Каждая выполняется
+# в своей транзакции; старые bot_database.db обновляются при запуске.
+# Уже выпущенные миграции не меняем - только добавляем новые.
+MIGRATIONS = [
+    (1, "базовые таблицы", [
+        '''
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER PRIMARY KEY,
+            welcome_message TEXT,
+            rules TEXT,
+            warn_limit INTEGER DEFAULT 3,
+            antiflood_enabled BOOLEAN DEFAULT 1,
+            antiflood_count INTEGER DEFAULT 5,
+            antiflood_seconds INTEGER DEFAULT 10,
+            bad_words TEXT DEFAULT '[]'
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS warnings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            user_id INTEGER,
+            warned_by INTEGER,
+            reason TEXT,
+            created_at TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS muted_users (
+            chat_id INTEGER,
+            user_id INTEGER,
+            mute_until TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            chat_id INTEGER,
+            user_id INTEGER,
+            messages_count INTEGER DEFAULT 0,
+            first_seen TIMESTAMP,
+            last_seen TIMESTAMP,
+            PRIMARY KEY (chat_id, user_id)
+        )
+        ''',
+    ]),
+    (2, "индекс предупреждений и счетчик предупреждений", [
+        "CREATE INDEX IF NOT EXISTS idx_warnings_chat_user ON warnings (chat_id, user_id, created_at)",
+        '''
+        CREATE TABLE IF NOT EXISTS warning_counts (
+            chat_id INTEGER,
+            user_id INTEGER,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, user_id)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        INSERT OR REPLACE INTO warning_counts (chat_id, user_id, count)
+        SELECT chat_id, user_id, COUNT(*) FROM warnings GROUP BY chat_id, user_id
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS warnings_count_insert AFTER INSERT ON warnings
+        BEGIN
+            INSERT INTO warning_counts (chat_id, user_id, count)
+            VALUES (NEW.chat_id, NEW.user_id, 1)
+            ON CONFLICT (chat_id, user_id) DO UPDATE SET count = count + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS warnings_count_delete AFTER DELETE ON warnings
+        BEGIN
+            UPDATE warning_counts SET count = count - 1
+            WHERE chat_id = OLD.chat_id AND user_id = OLD.user_id;
+            DELETE FROM warning_counts
+            WHERE chat_id = OLD.chat_id AND user_id = OLD.user_id AND count <= 0;
+        END
+        ''',
+    ]),
+    (3, "пороги наплыва вступлений и режима рейда", [
+        f"ALTER TABLE chat_settings ADD COLUMN join_burst_threshold INTEGER DEFAULT {DEFAULT_JOIN_BURST_THRESHOLD}",
+        f"ALTER TABLE chat_settings ADD COLUMN raid_threshold INTEGER DEFAULT {DEFAULT_RAID_THRESHOLD}",
+    ]),
+    (4, "сводки активности по периодам и имена в статистике", [
+        "ALTER TABLE user_stats ADD COLUMN username TEXT",
+        "ALTER TABLE user_stats ADD COLUMN first_name TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_user_stats_top ON user_stats (chat_id, messages_count)",
+        # bucket - начало периода (unix-время), period - одно из ROLLUP_PERIODS
+        '''
+        CREATE TABLE IF NOT EXISTS user_activity (
+            chat_id INTEGER,
+            period TEXT,
+            bucket INTEGER,
+            user_id INTEGER,
+            messages INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, period, bucket, user_id)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_user_activity_top ON user_activity (chat_id, period, bucket, messages)",
+        '''
+        CREATE TABLE IF NOT EXISTS chat_activity (
+            chat_id INTEGER,
+            period TEXT,
+            bucket INTEGER,
+            messages INTEGER NOT NULL,
+            users INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, period, bucket)
+        ) WITHOUT ROWID
+        ''',
+        # Итоги чата ведут триггеры: новая строка пользователя за период -
+        # еще один активный участник, обновление - только прирост сообщений
+        '''
+        CREATE TRIGGER IF NOT EXISTS user_activity_insert AFTER INSERT ON user_activity
+        BEGIN
+            INSERT INTO chat_activity (chat_id, period, bucket, messages, users)
+            VALUES (NEW.chat_id, NEW.period, NEW.bucket, NEW.messages, 1)
+            ON CONFLICT (chat_id, period, bucket) DO UPDATE SET
+                messages = messages + excluded.messages,
+                users = users + 1;
+        END
+        ''',
+        '''
+        CREATE TRIGGER IF NOT EXISTS user_activity_update AFTER UPDATE OF messages ON user_activity
+        BEGIN
+            UPDATE chat_activity SET messages = messages + NEW.messages - OLD.messages
+            WHERE chat_id = NEW.chat_id AND period = NEW.period AND bucket = NEW.bucket;
+        END
+        ''',
+    ]),
+    # Обслуживание выбирает устаревшие строки по этим индексам, а не просмотром таблиц
+    (5, "индексы для сроков хранения", [
+        "CREATE INDEX IF NOT EXISTS idx_warnings_created ON warnings (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_user_stats_last_seen ON user_stats (last_seen)",
+        "CREATE INDEX IF NOT EXISTS idx_muted_users_until ON muted_users (mute_until)",
+        "CREATE INDEX IF NOT EXISTS idx_user_activity_expiry ON user_activity (period, bucket)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_activity_expiry ON chat_activity (period, bucket)",
+    ]),
+]
+
+# Правила хранения: (таблица, ключ, условие «строка устарела»). Ключ - то, по
+# чему удаляется выбранная строка; условие - диапазон по индексу из миграции 5,
+# так что обслуживание читает только устаревшие строки. Параметры условия - из
+# retention_cutoffs(), и граница None (срок 0) не удаляет ничего
+RETENTION_POLICIES = [
+    ('warnings', ('id',), "created_at < :warnings_before"),
+    ('user_stats', ('chat_id', 'user_id'), "last_seen < :inactive_before"),
+    ('muted_users', ('chat_id', 'user_id'), "mute_until < :now"),
+    *((table, key, f"period = '{period}' AND bucket < :{period}_before")
+      for period in ROLLUP_PERIODS
+      for table, key in (('user_activity', ('chat_id', 'period', 'bucket', 'user_id')),
+                         ('chat_activity', ('chat_id', 'period', 'bucket')))),
+]
+
+def retention_cutoffs(now):
+    """Границы для условий RETENTION_POLICIES на момент now"""
+    def before(days):
+        return now - timedelta(days=days) if days else None
+    
+    def before_ts(days):
+        return int(before(days).timestamp()) if days else None
+    
+    return {
+        'now': now,
+        'warnings_before': before(WARNINGS_RETENTION_DAYS),
+        'inactive_before': before(INACTIVE_USER_RETENTION_DAYS),
+        'hour_before': before_ts(HOURLY_ACTIVITY_RETENTION_DAYS),
+        'day_before': before_ts(DAILY_ACTIVITY_RETENTION_DAYS),
+        'week_before': before_ts(WEEKLY_ACTIVITY_RETENTION_DAYS),
+        'month_before': before_ts(MONTHLY_ACTIVITY_RETENTION_DAYS),
+    }
+
+class RowArchive:
+    """Дописывает удаленные строки в <папка>/<таблица>-<время>.ndjson.gz.
+    
+    Файл таблицы создается при первой записи; каждая пачка сбрасывается
+    на диск до того, как ее удаление будет зафиксировано в БД.
+    """
+    def __init__(self, directory, stamp):
+        self.directory = directory
+        self.stamp = stamp
+        self.files = {}
+    
+    def write(self, table, columns, rows):
+        archive = self.files.get(table)
+        if archive is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{table}-{self.stamp}.ndjson.gz")
+            archive = self.files[table] = gzip.open(path, 'at', encoding='utf-8')
+        for row in rows:
+            archive.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False, default=str) + '\n')
+        archive.flush()
+    
+    def close(self):
+        for archive in self.files.values():
+            archive.close()
+        self.files.clear()
+
+# Что переносит выгрузка чата: таблица -> (как вставлять, пропускаемые
+# столбцы, окончание запроса). warning_counts и chat_activity не выгружаются -
+# их при загрузке заново построят триггеры
+CHAT_EXPORT_TABLES = {
+    'chat_settings': ("INSERT OR REPLACE", (), ""),
+    'warnings': ("INSERT", ('id',), ""),
+    'muted_users': ("INSERT OR REPLACE", (), ""),
+    'user_stats': ("INSERT OR REPLACE", (), ""),
+    'user_activity': ("INSERT", (), "ON CONFLICT (chat_id, period, bucket, user_id) DO UPDATE SET messages = excluded.messages"),
+}
+EXPORT_FORMAT = 'glavbot-chat'
+
+def parse_bad_words(settings):
+    """Достает список запрещенных слов из настроек чата"""
+    bad_words = settings.get('bad_words')
+    if bad_words:
+        return json.loads(bad_words)
+    return []
+
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect('bot_database.db', check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        self.create_tables()
-    
-    def create_tables(self):
-        # Настройки чатов
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS chat_settings (
-                chat_id INTEGER PRIMARY KEY,
-                welcome_message TEXT,
-                rules TEXT,
-                warn_limit INTEGER DEFAULT 3,
-                antiflood_enabled BOOLEAN DEFAULT 1,
-                antiflood_count INTEGER DEFAULT 5,
-                antiflood_seconds INTEGER DEFAULT 10,
-                bad_words TEXT DEFAULT '[]'
+    """Синхронный доступ к SQLite.
+    
+    Записи идут через self.conn и должны выполняться из одного потока
+    (см. AsyncDatabase). Чтения берут соединение своего потока - reader().
+    """
+    def __init__(self, path=DB_PATH, state=None):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        # Действует только для новой БД; старую переводит enable_incremental_vacuum()
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        apply_pragmas(self.conn)
+        self.local = threading.local()
+        self.reader_conns = []
+        self.lock = threading.Lock()
+        self.state = state or MemoryStateBackend()
+        self.stats_buffer = StatsBuffer()
+        self.settings_cache = self.state.settings_cache()
+        self.settings_columns = None
+        self.bad_word_matchers = {}
+        self.mute_index = self.state.mute_index()
+        self.migrate()
+    
+    def reader(self):
+        """Соединение для чтения, свое у каждого потока"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            apply_pragmas(conn)
+            self.local.conn = conn
+            with self.lock:
+                self.reader_conns.append(conn)
+        return conn
+    
+    def close(self):
+        with self.lock:
+            for conn in self.reader_conns:
+                conn.close()
+            self.reader_conns.clear()
+        self.conn.close()
+        self.state.close()
+    
+    def migrate(self):
+        """Доводит схему БД до последней версии из MIGRATIONS"""
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                applied_at TIMESTAMP
             )
         ''')
+        self.conn.commit()
+        current = self.conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0] or 0
         
-        # Предупреждения
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS warnings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                chat_id INTEGER,
-                user_id INTEGER,
-                warned_by INTEGER,
-                reason TEXT,
-                created_at TIMESTAMP
-            )
-        ''')
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            logger.info("Миграция БД до версии %s: %s", version, description)
+            self.conn.execute("BEGIN")
+            try:
+                for statement in statements:
+                    self.conn.execute(statement)
+                self.conn.execute(
+                    "INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                    (version, datetime.now())
+                )
+                self.conn.commit()
+            except sqlite3.Error:
+                self.conn.rollback()
+                raise
+    
+    def warm_up(self, limit=SETTINGS_CACHE_SIZE):
+        """Заполняет кэши до начала работы несколькими запросами.
         
-        # Заглушенные пользователи
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS muted_users (
-                chat_id INTEGER,
-                user_id INTEGER,
-                mute_until TIMESTAMP,
-                PRIMARY KEY (chat_id, user_id)
-            )
-        ''')
+        Муты, настройки и фильтры limit самых активных чатов грузятся разом,
+        а не отдельным SELECT на каждый чат, когда приходят первые сообщения.
+        До вызова муты из БД не видны is_muted().
+        """
+        started = time.perf_counter()
+        mutes = self.load_mutes()
         
-        # Статистика пользователей
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS user_stats (
-                chat_id INTEGER,
-                user_id INTEGER,
-                messages_count INTEGER DEFAULT 0,
-                first_seen TIMESTAMP,
-                last_seen TIMESTAMP,
-                PRIMARY KEY (chat_id, user_id)
-            )
-        ''')
+        cursor = self.conn.execute('''
+            SELECT s.* FROM chat_settings AS s
+            LEFT JOIN (
+                SELECT chat_id, MAX(bucket) AS last_active FROM chat_activity
+                WHERE period = 'day' GROUP BY chat_id
+            ) AS a ON a.chat_id = s.chat_id
+            ORDER BY a.last_active DESC NULLS LAST
+            LIMIT ?
+        ''', (limit,))
+        self.settings_columns = [description[0] for description in cursor.description]
+        chats = [typed_settings(self.settings_columns, row) for row in cursor]
+        chats.reverse()  # самые активные кладем последними - их LRU вытеснит позже всех
+        self.settings_cache.put_many((settings['chat_id'], settings) for settings in chats)
         
-        self.conn.commit()
+        # Чаты часто делят один и тот же список - такой компилируется один раз
+        compiled = {}
+        with self.lock:
+            for settings in chats:
+                words = tuple(parse_bad_words(settings))
+                if words and words not in compiled:
+                    compiled[words] = BadWordMatcher(words)
+                self.bad_word_matchers[settings['chat_id']] = compiled.get(words)
+        filters = sum(matcher is not None for matcher in self.bad_word_matchers.values())
+        
+        logger.info(
+            "Кэши прогреты за %.0f мс: чатов %s, мутов %s, фильтров %s (разных %s)",
+            (time.perf_counter() - started) * 1000, len(chats), mutes, filters, len(compiled)
+        )
     
     # Настройки чата
     def get_chat_settings(self, chat_id):
-        self.cursor.execute("SELECT * FROM chat_settings WHERE chat_id = ?", (chat_id,))
-        settings = self.cursor.fetchone()
+        settings = self.settings_cache.get(chat_id)
+        if settings is not None:
+            return settings
+        return self.load_chat_settings(chat_id)
+    
+    def load_chat_settings(self, chat_id):
+        """Читает настройки из БД (создавая их при первом обращении) и кэширует"""
+        cursor = self.conn.execute("SELECT * FROM chat_settings WHERE chat_id = ?", (chat_id,))
+        row = cursor.fetchone()
         
-        if not settings:
-            self.cursor.execute('''
+        if not row:
+            self.conn.execute('''
                 INSERT INTO chat_settings (chat_id, welcome_message, rules)
                 VALUES (?, ?, ?)
             ''', (chat_id, DEFAULT_WELCOME_MESSAGE, DEFAULT_RULES))
             self.conn.commit()
             
-            self.cursor.execute("SELECT * FROM chat_settings WHERE chat_id = ?", (chat_id,))
-            settings = self.cursor.fetchone()
+            cursor = self.conn.execute("SELECT * FROM chat_settings WHERE chat_id = ?", (chat_id,))
+            row = cursor.fetchone()
         
-        columns = [description[0] for description in self.cursor.description]
-        return dict(zip(columns, settings))
+        if self.settings_columns is None:
+            self.settings_columns = [description[0] for description in cursor.description]
+        settings = typed_settings(self.settings_columns, row)
+        self.settings_cache.put(chat_id, settings)
+        return settings
     
     def update_welcome(self, chat_id, message):
-        self.cursor.execute("UPDATE chat_settings SET welcome_message = ? WHERE chat_id = ?", (message, chat_id))
+        self.conn.execute("UPDATE chat_settings SET welcome_message = ? WHERE chat_id = ?", (message, chat_id))
         self.conn.commit()
+        self.settings_cache.update(chat_id, 'welcome_message', message)
     
     def update_rules(self, chat_id, rules):
-        self.cursor.execute("UPDATE chat_settings SET rules = ? WHERE chat_id = ?", (rules, chat_id))
+        self.conn.execute("UPDATE chat_settings SET rules = ? WHERE chat_id = ?", (rules, chat_id))
         self.conn.commit()
+        self.settings_cache.update(chat_id, 'rules', rules)
     
     def get_bad_words(self, chat_id):
-        self.cursor.execute("SELECT bad_words FROM chat_settings WHERE chat_id = ?", (chat_id,))
-        result = self.cursor.fetchone()
-        if result and result[0]:
-            return json.loads(result[0])
-        return []
+        return parse_bad_words(self.get_chat_settings(chat_id))
+    
+    def update_join_thresholds(self, chat_id, burst_threshold, raid_threshold):
+        self.conn.execute(
+            "UPDATE chat_settings SET join_burst_threshold = ?, raid_threshold = ? WHERE chat_id = ?",
+            (burst_threshold, raid_threshold, chat_id)
+        )
+        self.conn.commit()
+        self.settings_cache.update(chat_id, 'join_burst_threshold', burst_threshold)
+        self.settings_cache.update(chat_id, 'raid_threshold', raid_threshold)
     
     def update_bad_words(self, chat_id, words_list):
-        self.cursor.execute("UPDATE chat_settings SET bad_words = ? WHERE chat_id = ?", (json.dumps(words_list), chat_id))
+        bad_words = json.dumps(words_list)
+        self.conn.execute("UPDATE chat_settings SET bad_words = ? WHERE chat_id = ?", (bad_words, chat_id))
         self.conn.commit()
+        self.settings_cache.update(chat_id, 'bad_words', bad_words)
+        self.bad_word_matchers.pop(chat_id, None)
+    
+    def get_bad_word_matcher(self, chat_id):
+        """Возвращает скомпилированный фильтр чата или None, если список пуст"""
+        matcher = self.bad_word_matchers.get(chat_id, MISSING)
+        if matcher is not MISSING:
+            return matcher
+        
+        words = self.get_bad_words(chat_id)
+        matcher = BadWordMatcher(words) if words else None
+        with self.lock:
+            if len(self.bad_word_matchers) >= SETTINGS_CACHE_SIZE:
+                self.bad_word_matchers.pop(next(iter(self.bad_word_matchers)), None)
+            self.bad_word_matchers[chat_id] = matcher
+        return matcher
     
     # Предупреждения
     def add_warning(self, chat_id, user_id, warned_by, reason=None):
-        self.cursor.execute('''
+        self.conn.execute('''
             INSERT INTO warnings (chat_id, user_id, warned_by, reason, created_at)
             VALUES (?, ?, ?, ?, ?)
         ''', (chat_id, user_id, warned_by, reason, datetime.now()))
@@ -176,14 +1287,16 @@ class Database:
         return self.get_warnings_count(chat_id, user_id)
     
     def get_warnings_count(self, chat_id, user_id):
-        self.cursor.execute('''
-            SELECT COUNT(*) FROM warnings
+        # Счетчик ведут триггеры на warnings (см. миграцию 2)
+        cursor = self.reader().execute('''
+            SELECT count FROM warning_counts
             WHERE chat_id = ? AND user_id = ?
         ''', (chat_id, user_id))
-        return self.cursor.fetchone()[0]
+        row = cursor.fetchone()
+        return row[0] if row else 0
     
     def remove_warning(self, chat_id, user_id):
-        self.cursor.execute('''
+        self.conn.execute('''
             DELETE FROM warnings
             WHERE id = (
                 SELECT id FROM warnings
@@ -195,72 +1308,1313 @@ class Database:
         return self.get_warnings_count(chat_id, user_id)
     
     def clear_warnings(self, chat_id, user_id):
-        self.cursor.execute("DELETE FROM warnings WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+        self.conn.execute("DELETE FROM warnings WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
         self.conn.commit()
     
     # Муты
+    def load_mutes(self):
+        """Загружает муты из БД в индекс одним запросом; истекшие снимет expire_mutes"""
+        cursor = self.conn.execute("SELECT chat_id, user_id, mute_until FROM muted_users")
+        mutes = [
+            (chat_id, user_id, datetime.fromisoformat(mute_until).timestamp())
+            for chat_id, user_id, mute_until in cursor
+        ]
+        self.mute_index.add_many(mutes)
+        return len(mutes)
+    
     def add_mute(self, chat_id, user_id, duration_seconds):
         mute_until = datetime.now() + timedelta(seconds=duration_seconds)
-        self.cursor.execute('''
+        self.conn.execute('''
             INSERT OR REPLACE INTO muted_users (chat_id, user_id, mute_until)
             VALUES (?, ?, ?)
         ''', (chat_id, user_id, mute_until))
         self.conn.commit()
+        self.mute_index.add(chat_id, user_id, mute_until.timestamp())
         return mute_until
     
     def remove_mute(self, chat_id, user_id):
-        self.cursor.execute("DELETE FROM muted_users WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+        self.conn.execute("DELETE FROM muted_users WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
         self.conn.commit()
+        self.mute_index.remove(chat_id, user_id)
     
     def is_muted(self, chat_id, user_id):
-        self.cursor.execute('''
-            SELECT mute_until FROM muted_users
-            WHERE chat_id = ? AND user_id = ?
-        ''', (chat_id, user_id))
-        
-        result = self.cursor.fetchone()
-        if not result:
-            return False
-        
-        mute_until = datetime.fromisoformat(result[0])
-        if mute_until > datetime.now():
-            return True
-        else:
-            self.remove_mute(chat_id, user_id)
-            return False
+        return self.mute_index.is_muted(chat_id, user_id, time.time())
+    
+    def expire_mutes(self):
+        """Снимает истекшие муты из индекса и удаляет их из БД пачками"""
+        removed = 0
+        now = time.time()
+        while True:
+            expired = self.mute_index.pop_expired(now, MUTE_EXPIRY_BATCH)
+            if not expired:
+                break
+            self.conn.executemany(
+                "DELETE FROM muted_users WHERE chat_id = ? AND user_id = ?", expired
+            )
+            self.conn.commit()
+            removed += len(expired)
+        return removed
     
     # Статистика
     def update_user_stats(self, chat_id, user_id, username, first_name):
-        now = datetime.now()
-        self.cursor.execute('''
-            INSERT OR REPLACE INTO user_stats 
-            (chat_id, user_id, messages_count, first_seen, last_seen)
-            VALUES (?, ?, 
-                COALESCE(
-                    (SELECT messages_count + 1 FROM user_stats 
-                     WHERE chat_id = ? AND user_id = ?),
-                    1
-                ),
-                COALESCE(
-                    (SELECT first_seen FROM user_stats 
-                     WHERE chat_id = ? AND user_id = ?),
-                    ?
-                ),
-                ?)
-        ''', (chat_id, user_id, chat_id, user_id, chat_id, user_id, now, now))
-        self.conn.commit()
+        """Учитывает сообщение в буфере; в БД счетчики попадают при сбросе"""
+        if self.stats_buffer.add(chat_id, user_id, username, first_name, time.time()):
+            self.flush_user_stats()
+    
+    def flush_user_stats(self):
+        """Записывает накопленную статистику и сводки активности одной транзакцией"""
+        pending = self.stats_buffer.take()
+        if not pending:
+            return 0
+        
+        rows = []
+        activity = []
+        for (chat_id, user_id), (count, first_seen, last_seen, username, first_name, hours) in pending.items():
+            rows.append((
+                chat_id, user_id, count,
+                datetime.fromtimestamp(first_seen), datetime.fromtimestamp(last_seen),
+                username, first_name,
+            ))
+            for hour, messages in hours.items():
+                for period, bucket in rollup_buckets(hour):
+                    activity.append((chat_id, period, bucket, user_id, messages))
+        try:
+            self.conn.executemany('''
+                INSERT INTO user_stats (chat_id, user_id, messages_count, first_seen, last_seen,
+                                        username, first_name)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                    messages_count = messages_count + excluded.messages_count,
+                    last_seen = excluded.last_seen,
+                    username = excluded.username,
+                    first_name = excluded.first_name
+            ''', rows)
+            self.conn.executemany('''
+                INSERT INTO user_activity (chat_id, period, bucket, user_id, messages)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (chat_id, period, bucket, user_id) DO UPDATE SET
+                    messages = messages + excluded.messages
+            ''', activity)
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            self.stats_buffer.restore(pending)
+            raise
+        return len(rows)
     
     def get_user_stats(self, chat_id, user_id):
-        self.cursor.execute('''
+        cursor = self.reader().execute('''
             SELECT * FROM user_stats
             WHERE chat_id = ? AND user_id = ?
         ''', (chat_id, user_id))
         
-        result = self.cursor.fetchone()
+        result = cursor.fetchone()
+        stats = None
         if result:
-            columns = [description[0] for description in self.cursor.description]
-            return dict(zip(columns, result))
-        return None
+            columns = [description[0] for description in cursor.description]
+            stats = dict(zip(columns, result))
+        
+        # Досчитываем то, что еще не сброшено в БД
+        pending = self.stats_buffer.get(chat_id, user_id)
+        if pending:
+            count, first_seen, last_seen = pending
+            if stats is None:
+                stats = {
+                    'chat_id': chat_id,
+                    'user_id': user_id,
+                    'messages_count': 0,
+                    'first_seen': str(datetime.fromtimestamp(first_seen)),
+                }
+            stats['messages_count'] += count
+            stats['last_seen'] = str(datetime.fromtimestamp(last_seen))
+        return stats
+    
+    def get_top_users(self, chat_id, period=None, limit=TOP_LIMIT):
+        """Самые активные за текущий период (None - за все время).
+        
+        Читает только верхушку индекса по одному периоду, сколько бы
+        участников ни было в чате. Возвращает [(user_id, username, имя, сообщений)].
+        """
+        if period is None:
+            return self.reader().execute('''
+                SELECT user_id, username, first_name, messages_count FROM user_stats
+                WHERE chat_id = ?
+                ORDER BY messages_count DESC LIMIT ?
+            ''', (chat_id, limit)).fetchall()
+        return self.reader().execute('''
+            SELECT a.user_id, s.username, s.first_name, a.messages
+            FROM user_activity AS a
+            LEFT JOIN user_stats AS s ON s.chat_id = a.chat_id AND s.user_id = a.user_id
+            WHERE a.chat_id = ? AND a.period = ? AND a.bucket = ?
+            ORDER BY a.messages DESC LIMIT ?
+        ''', (chat_id, period, current_bucket(period), limit)).fetchall()
+    
+    def get_chat_activity(self, chat_id, period, since):
+        """Итоги чата по периодам начиная с since: [(начало, сообщений, участников)]"""
+        return self.reader().execute('''
+            SELECT bucket, messages, users FROM chat_activity
+            WHERE chat_id = ? AND period = ? AND bucket >= ?
+            ORDER BY bucket
+        ''', (chat_id, period, since)).fetchall()
+    
+    # Обслуживание
+    def prune_step(self, table, key, condition, cutoffs, archive=None, batch=MAINTENANCE_BATCH):
+        """Удаляет до batch устаревших строк таблицы (condition из RETENTION_POLICIES).
+        
+        Строки выбираются по индексу условия, так что шаг читает только то,
+        что удаляет, и недолго занимает поток записи, сколько бы строк ни было
+        в таблице. Возвращает число удаленных строк; меньше batch - больше нет.
+        """
+        cursor = self.conn.execute(
+            f"SELECT * FROM {table} WHERE {condition} LIMIT :batch", dict(cutoffs, batch=batch)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return 0
+        
+        names = [description[0] for description in cursor.description]
+        positions = [names.index(column) for column in key]
+        if archive is not None:
+            archive.write(table, names, rows)
+        self.conn.executemany(
+            f"DELETE FROM {table} WHERE ({', '.join(key)}) = ({', '.join('?' * len(key))})",
+            [tuple(row[i] for i in positions) for row in rows]
+        )
+        self.conn.commit()
+        return len(rows)
+    
+    def enable_incremental_vacuum(self):
+        """Переводит БД, созданную без auto_vacuum, в режим INCREMENTAL.
+        
+        Для старого файла это один полный VACUUM, который держит запись на все
+        время перезаписи, - поэтому вызывается при запуске, до обработки
+        обновлений (init_storage), а не из обслуживания. Возвращает True,
+        если VACUUM понадобился.
+        """
+        if self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+            return False
+        started = time.monotonic()
+        self.conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        self.conn.execute("VACUUM")
+        logger.info("БД переведена в режим auto_vacuum=INCREMENTAL за %.1f с", time.monotonic() - started)
+        return True
+    
+    def vacuum_step(self, pages=MAINTENANCE_VACUUM_PAGES):
+        """Отдает ОС до pages свободных страниц; возвращает, сколько еще осталось"""
+        self.conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+        return self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+    
+    def analyze(self):
+        """Обновляет статистику планировщика и переносит WAL в основной файл"""
+        self.conn.execute("PRAGMA analysis_limit=1000")
+        self.conn.execute("ANALYZE")
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+    
+    # Резервная копия и перенос чатов
+    def backup(self, path, pages=BACKUP_PAGES, pause=BACKUP_PAUSE):
+        """Онлайн-копия БД в path через backup API SQLite, по pages страниц за шаг.
+        
+        Источник - соединение записи: то, что бот запишет через него во время
+        копирования, сразу попадет и в копию, так что копирование не начинается
+        заново. Это верно только внутри процесса бота: запись из любого другого
+        соединения начинает копирование сначала, поэтому снаружи нужен snapshot().
+        Вызывать из отдельного потока: между шагами соединение свободно
+        для записей. Копия пишется во временный файл и целиком подменяет path.
+        """
+        started = time.monotonic()
+        tmp_path = f"{path}.tmp"
+        target = sqlite3.connect(tmp_path)
+        try:
+            # sleep= в sqlite3 ждет только при занятой БД; паузу между шагами делает progress
+            self.conn.backup(target, pages=pages, progress=lambda *progress: time.sleep(pause))
+        finally:
+            target.close()
+        os.replace(tmp_path, path)
+        logger.info("Копия БД в %s за %.1f с (%s байт)", path, time.monotonic() - started, os.path.getsize(path))
+    
+    def snapshot(self, path):
+        """Копия БД в path одной читающей транзакцией (VACUUM INTO).
+        
+        Для копии из другого процесса, пока бот пишет в БД: чтение идет по
+        снимку WAL, чужие записи его не прерывают и сами его не ждут.
+        """
+        started = time.monotonic()
+        tmp_path = f"{path}.tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)  # VACUUM INTO не пишет в существующий файл
+        self.reader().execute("VACUUM INTO ?", (tmp_path,))
+        os.replace(tmp_path, path)
+        logger.info("Снимок БД в %s за %.1f с (%s байт)", path, time.monotonic() - started, os.path.getsize(path))
+    
+    def export_chat(self, chat_id, path):
+        """Выгружает данные чата в path (NDJSON, gzip), не держа строки в памяти.
+        
+        Первая строка - заголовок с версией схемы, дальше {"table": ..., "row": {...}}.
+        Все таблицы читаются в одной транзакции, то есть из одного снимка БД.
+        Возвращает {таблица: строк}.
+        """
+        conn = self.reader()
+        counts = {}
+        conn.execute("BEGIN")
+        try:
+            version = conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0]
+            with gzip.open(path, 'wt', encoding='utf-8') as output:
+                header = {'format': EXPORT_FORMAT, 'version': version, 'chat_id': chat_id,
+                          'exported_at': datetime.now().isoformat()}
+                output.write(json.dumps(header) + '\n')
+                for table in CHAT_EXPORT_TABLES:
+                    cursor = conn.execute(f"SELECT * FROM {table} WHERE chat_id = ?", (chat_id,))
+                    names = [description[0] for description in cursor.description]
+                    counts[table] = 0
+                    for row in cursor:
+                        record = {'table': table, 'row': dict(zip(names, row))}
+                        output.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+                        counts[table] += 1
+        finally:
+            conn.rollback()
+        return counts
+    
+    def import_chat(self, path, chat_id=None, batch=EXPORT_BATCH):
+        """Загружает выгрузку export_chat; chat_id - записать данные в другой чат.
+        
+        Строки вставляются пачками по batch в отдельных транзакциях.
+        Настройки, муты и статистика заменяются, предупреждения добавляются
+        к имеющимся. Возвращает {таблица: строк}.
+        
+        Сбрасываются кэши только этого процесса: бот, запущенный отдельно,
+        держит настройки, фильтр слов и муты в памяти без срока жизни и
+        загруженного не увидит до перезапуска. Загружать при остановленном боте.
+        """
+        counts = {}
+        pending = []
+        statement = None
+        
+        def flush():
+            if pending:
+                self.conn.executemany(statement, pending)
+                self.conn.commit()
+                pending.clear()
+        
+        with gzip.open(path, 'rt', encoding='utf-8') as source:
+            header = json.loads(source.readline() or '{}')
+            if header.get('format') != EXPORT_FORMAT:
+                raise ValueError(f"{path}: это не выгрузка чата")
+            current = self.conn.execute("SELECT MAX(version) FROM schema_version").fetchone()[0]
+            if header['version'] > current:
+                raise ValueError(f"{path}: выгрузка из более новой версии БД ({header['version']} > {current})")
+            
+            table_columns = {
+                table: {row[1] for row in self.conn.execute(f"PRAGMA table_info({table})")}
+                for table in CHAT_EXPORT_TABLES
+            }
+            shape = None
+            for line in source:
+                record = json.loads(line)
+                table, row = record['table'], record['row']
+                verb, skipped, suffix = CHAT_EXPORT_TABLES[table]
+                if chat_id is not None:
+                    row['chat_id'] = chat_id
+                columns = tuple(
+                    column for column in row if column in table_columns[table] and column not in skipped
+                )
+                if (table, columns) != shape or len(pending) >= batch:
+                    flush()
+                    shape = (table, columns)
+                    statement = (
+                        f"{verb} INTO {table} ({', '.join(columns)}) "
+                        f"VALUES ({', '.join('?' * len(columns))}) {suffix}"
+                    )
+                pending.append(tuple(row[column] for column in columns))
+                counts[table] = counts.get(table, 0) + 1
+            flush()
+        
+        # Загруженные настройки и муты должны быть видны этому процессу сразу
+        target = header['chat_id'] if chat_id is None else chat_id
+        self.settings_cache.invalidate(target)
+        self.bad_word_matchers.pop(target, None)
+        cursor = self.conn.execute("SELECT user_id, mute_until FROM muted_users WHERE chat_id = ?", (target,))
+        for user_id, mute_until in cursor.fetchall():
+            self.mute_index.add(target, user_id, datetime.fromisoformat(mute_until).timestamp())
+        return counts
+
+# ==================== ХРАНИЛИЩЕ СОСТОЯНИЯ ====================
+# Антифлуд, активные муты и кэш настроек создаются через хранилище состояния.
+# Хранилище - объект с методами flood_limiter(**параметры), mute_index(),
+# settings_cache() и close(). Другое хранилище (например, Redis) достаточно
+# добавить в STATE_BACKENDS; в тестах его заменяет MemoryStateBackend.
+# Антифлуд, индекс мутов и кэш настроек с blocking = True могут ждать другие
+# процессы (блокировку файла, сеть), поэтому обработчики вызывают их из пула
+# потоков; у такого кэша настроек есть peek() - поиск только в памяти процесса.
+class MemoryStateBackend:
+    """Состояние в памяти процесса: быстро, но теряется при перезапуске"""
+    def flood_limiter(self, **options):
+        return FloodLimiter(**options)
+    
+    def mute_index(self):
+        return MuteIndex()
+    
+    def settings_cache(self):
+        return SettingsCache()
+    
+    def close(self):
+        pass
+
+STATE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS flood_hits (
+        chat_id INTEGER,
+        user_id INTEGER,
+        ts REAL
+    );
+    CREATE INDEX IF NOT EXISTS idx_flood_hits ON flood_hits(chat_id, user_id, ts);
+    CREATE TABLE IF NOT EXISTS flood_buckets (
+        chat_id INTEGER,
+        user_id INTEGER,
+        tokens REAL,
+        updated_at REAL,
+        PRIMARY KEY (chat_id, user_id)
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS active_mutes (
+        chat_id INTEGER,
+        user_id INTEGER,
+        until REAL,
+        PRIMARY KEY (chat_id, user_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS idx_active_mutes_until ON active_mutes(until);
+    CREATE TABLE IF NOT EXISTS settings_cache (
+        chat_id INTEGER PRIMARY KEY,
+        settings TEXT
+    );
+"""
+
+class SQLiteState:
+    """Файл SQLite с общим состоянием; у каждого потока свое соединение"""
+    def __init__(self, path=STATE_PATH):
+        self.path = path
+        self.local = threading.local()
+        self.conns = []
+        self.lock = threading.Lock()
+        self.connection().executescript(STATE_SCHEMA)
+    
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # Транзакции открываются явно (BEGIN IMMEDIATE), чтобы процессы не мешали друг другу
+            conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            apply_pragmas(conn)
+            conn.execute("PRAGMA synchronous=OFF")  # состояние временное, fsync не нужен
+            self.local.conn = conn
+            with self.lock:
+                self.conns.append(conn)
+        return conn
+    
+    @contextmanager
+    def transaction(self):
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+    
+    def close(self):
+        with self.lock:
+            for conn in self.conns:
+                conn.close()
+            self.conns.clear()
+
+class SharedFloodLimiter:
+    """Антифлуд в общем SQLite: окно считается по всем процессам бота.
+    
+    Время - настенное (time.time), чтобы его можно было сравнивать между
+    процессами. Устаревшие записи удаляются раз в prune_every сообщений.
+    """
+    blocking = True  # BEGIN IMMEDIATE ждет другие процессы до busy_timeout
+    
+    def __init__(self, state, algorithm=ANTIFLOOD_ALGORITHM, maxsize=10000, ttl=60,
+                 timer=time.time, prune_every=1000):
+        if algorithm not in ('window', 'bucket'):
+            raise ValueError(f"Неизвестный алгоритм антифлуда: {algorithm}")
+        self.state = state
+        self.algorithm = algorithm
+        self.ttl = ttl
+        self.timer = timer
+        self.prune_every = prune_every
+        self.max_seconds = ttl
+        self.hits = 0
+        self.expirations = 0
+        self._check = self._check_window if algorithm == 'window' else self._check_bucket
+    
+    def hit(self, chat_id, user_id, limit, seconds):
+        """Учитывает сообщение. Возвращает True, если лимит превышен"""
+        now = self.timer()
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.hits += 1
+        with self.state.transaction() as conn:
+            if self.hits % self.prune_every == 0:
+                self._prune(conn, now)
+            return self._check(conn, chat_id, user_id, now, limit, seconds)
+    
+    def _check_window(self, conn, chat_id, user_id, now, limit, seconds):
+        conn.execute("DELETE FROM flood_hits WHERE chat_id = ? AND user_id = ? AND ts < ?",
+                     (chat_id, user_id, now - seconds))
+        conn.execute("INSERT INTO flood_hits VALUES (?, ?, ?)", (chat_id, user_id, now))
+        count = conn.execute("SELECT COUNT(*) FROM flood_hits WHERE chat_id = ? AND user_id = ?",
+                             (chat_id, user_id)).fetchone()[0]
+        return count > limit
+    
+    def _check_bucket(self, conn, chat_id, user_id, now, limit, seconds):
+        row = conn.execute("SELECT tokens, updated_at FROM flood_buckets WHERE chat_id = ? AND user_id = ?",
+                           (chat_id, user_id)).fetchone()
+        tokens = limit if row is None else min(limit, row[0] + (now - row[1]) * limit / seconds)
+        flooded = tokens < 1
+        if not flooded:
+            tokens -= 1
+        conn.execute("INSERT OR REPLACE INTO flood_buckets VALUES (?, ?, ?, ?)",
+                     (chat_id, user_id, tokens, now))
+        return flooded
+    
+    def _prune(self, conn, now):
+        # За max_seconds простоя окно пустеет, а ведро наполняется - строки не нужны
+        cutoff = now - self.max_seconds
+        removed = conn.execute("DELETE FROM flood_hits WHERE ts < ?", (cutoff,)).rowcount
+        removed += conn.execute("DELETE FROM flood_buckets WHERE updated_at < ?", (cutoff,)).rowcount
+        self.expirations += removed
+    
+    def stats(self):
+        table = 'flood_hits' if self.algorithm == 'window' else 'flood_buckets'
+        size = self.state.connection().execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        return {
+            'size': size,
+            'evictions': 0,
+            'expirations': self.expirations,
+        }
+
+class SharedMuteIndex:
+    """Активные муты в общем SQLite; истекший мут снимает ровно один процесс"""
+    blocking = True
+    
+    def __init__(self, state):
+        self.state = state
+    
+    def add(self, chat_id, user_id, until):
+        self.state.connection().execute(
+            "INSERT OR REPLACE INTO active_mutes VALUES (?, ?, ?)", (chat_id, user_id, until)
+        )
+    
+    def add_many(self, mutes):
+        with self.state.transaction() as conn:
+            conn.executemany("INSERT OR REPLACE INTO active_mutes VALUES (?, ?, ?)", mutes)
+    
+    def remove(self, chat_id, user_id):
+        self.state.connection().execute(
+            "DELETE FROM active_mutes WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
+        )
+    
+    def is_muted(self, chat_id, user_id, now):
+        row = self.state.connection().execute(
+            "SELECT until FROM active_mutes WHERE chat_id = ? AND user_id = ?", (chat_id, user_id)
+        ).fetchone()
+        return row is not None and row[0] > now
+    
+    def pop_expired(self, now, limit):
+        """Убирает из индекса до limit истекших мутов и возвращает их ключи"""
+        with self.state.transaction() as conn:
+            expired = conn.execute(
+                "SELECT chat_id, user_id FROM active_mutes WHERE until <= ? ORDER BY until LIMIT ?",
+                (now, limit)
+            ).fetchall()
+            conn.executemany("DELETE FROM active_mutes WHERE chat_id = ? AND user_id = ?", expired)
+        return expired
+    
+    def __len__(self):
+        return self.state.connection().execute("SELECT COUNT(*) FROM active_mutes").fetchone()[0]
+
+class SharedSettingsCache:
+    """Кэш настроек в общем SQLite с короткой локальной копией.
+    
+    Изменения, сделанные другим процессом, становятся видны не позже чем
+    через local_ttl секунд. Словари из кэша отдаются как есть - не изменяйте их.
+    """
+    blocking = True
+    
+    def __init__(self, state, maxsize=SETTINGS_CACHE_SIZE, local_ttl=STATE_SETTINGS_TTL):
+        self.state = state
+        self.local = TTLCache(maxsize=maxsize, ttl=local_ttl)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+    
+    def peek(self, chat_id):
+        """Настройки из локальной копии или None; в общий SQLite не ходит"""
+        with self.lock:
+            settings = self.local.get(chat_id)
+            if settings is not None:
+                self.hits += 1
+            return settings
+    
+    def get(self, chat_id):
+        settings = self.peek(chat_id)
+        if settings is not None:
+            return settings
+        row = self.state.connection().execute(
+            "SELECT settings FROM settings_cache WHERE chat_id = ?", (chat_id,)
+        ).fetchone()
+        settings = json.loads(row[0]) if row is not None else None
+        with self.lock:
+            if settings is None:
+                self.misses += 1
+                return None
+            self.local[chat_id] = settings
+            self.hits += 1
+        return settings
+    
+    def put(self, chat_id, settings):
+        self.state.connection().execute(
+            "INSERT OR REPLACE INTO settings_cache VALUES (?, ?)", (chat_id, json.dumps(settings))
+        )
+        with self.lock:
+            self.local[chat_id] = settings
+    
+    def put_many(self, items):
+        items = list(items)
+        with self.state.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO settings_cache VALUES (?, ?)",
+                [(chat_id, json.dumps(settings)) for chat_id, settings in items]
+            )
+        with self.lock:
+            for chat_id, settings in items:
+                self.local[chat_id] = settings
+    
+    def update(self, chat_id, column, value):
+        """Обновляет поле, если чат в кэше (write-through после UPDATE в БД)"""
+        cast = SETTINGS_TYPES.get(column)
+        value = cast(value) if cast and value is not None else value
+        with self.state.transaction() as conn:
+            row = conn.execute("SELECT settings FROM settings_cache WHERE chat_id = ?", (chat_id,)).fetchone()
+            if row is None:
+                settings = None
+            else:
+                settings = json.loads(row[0])
+                settings[column] = value
+                conn.execute("UPDATE settings_cache SET settings = ? WHERE chat_id = ?",
+                             (json.dumps(settings), chat_id))
+        with self.lock:
+            if settings is None:
+                self.local.pop(chat_id, None)
+            else:
+                self.local[chat_id] = settings
+    
+    def invalidate(self, chat_id):
+        self.state.connection().execute("DELETE FROM settings_cache WHERE chat_id = ?", (chat_id,))
+        with self.lock:
+            self.local.pop(chat_id)
+    
+    def stats(self):
+        return {
+            'size': len(self.local),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.local.stats()['evictions'],
+        }
+
+class SQLiteStateBackend:
+    """Состояние в общем файле SQLite: его видят все процессы бота на машине"""
+    def __init__(self, path=STATE_PATH):
+        self.state = SQLiteState(path)
+    
+    def flood_limiter(self, **options):
+        return SharedFloodLimiter(self.state, **options)
+    
+    def mute_index(self):
+        return SharedMuteIndex(self.state)
+    
+    def settings_cache(self):
+        return SharedSettingsCache(self.state)
+    
+    def close(self):
+        self.state.close()
+
+STATE_BACKENDS = {
+    'memory': MemoryStateBackend,
+    'sqlite': SQLiteStateBackend,
+}
+
+def create_state_backend(name=STATE_BACKEND, **options):
+    backend = STATE_BACKENDS.get(name)
+    if backend is None:
+        raise ValueError(f"Неизвестное хранилище состояния: {name}")
+    return backend(**options)
+
+# ==================== АСИНХРОННЫЙ ДОСТУП К БД ====================
+class AsyncDatabase:
+    """Неблокирующий фасад над Database для асинхронных обработчиков.
+    
+    SQLite допускает одного писателя, поэтому все записи выполняются по
+    очереди в отдельном потоке. Чтения из БД идут через небольшой пул потоков
+    со своими соединениями. То, что уже лежит в памяти (муты, кэш настроек,
+    буфер статистики), отдается сразу, без перехода в другой поток.
+    """
+    def __init__(self, db, read_connections=DB_READ_CONNECTIONS):
+        self.db = db
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        self.readers = ThreadPoolExecutor(max_workers=read_connections, thread_name_prefix='db-reader')
+        self.reports = TTLCache(maxsize=SETTINGS_CACHE_SIZE, ttl=STATS_REPORT_TTL)
+        self.flushing = None
+    
+    @staticmethod
+    def _timed(func, *args):
+        with metrics.timer('bot_db_seconds', errors='bot_db_errors_total', method=func.__name__):
+            return func(*args)
+    
+    async def _write(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.writer, self._timed, func, *args)
+    
+    async def _read(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.readers, self._timed, func, *args)
+    
+    def close(self):
+        self.writer.shutdown(wait=True)
+        self.readers.shutdown(wait=True)
+        self.db.close()
+    
+    # Настройки чата
+    async def get_chat_settings(self, chat_id):
+        cache = self.db.settings_cache
+        if cache.blocking:
+            settings = cache.peek(chat_id) or await self._read(cache.get, chat_id)
+        else:
+            settings = cache.get(chat_id)
+        if settings is not None:
+            return settings
+        # Промах может создать строку настроек - это запись
+        return await self._write(self.db.load_chat_settings, chat_id)
+    
+    async def update_welcome(self, chat_id, message):
+        await self._write(self.db.update_welcome, chat_id, message)
+    
+    async def update_rules(self, chat_id, rules):
+        await self._write(self.db.update_rules, chat_id, rules)
+    
+    async def update_join_thresholds(self, chat_id, burst_threshold, raid_threshold):
+        await self._write(self.db.update_join_thresholds, chat_id, burst_threshold, raid_threshold)
+    
+    async def get_bad_words(self, chat_id):
+        return parse_bad_words(await self.get_chat_settings(chat_id))
+    
+    async def update_bad_words(self, chat_id, words_list):
+        await self._write(self.db.update_bad_words, chat_id, words_list)
+    
+    async def get_bad_word_matcher(self, chat_id):
+        matcher = self.db.bad_word_matchers.get(chat_id, MISSING)
+        if matcher is not MISSING:
+            return matcher
+        # Компилируем в потоке писателя, чтобы не разойтись с update_bad_words
+        return await self._write(self.db.get_bad_word_matcher, chat_id)
+    
+    # Предупреждения
+    async def add_warning(self, chat_id, user_id, warned_by, reason=None):
+        return await self._write(self.db.add_warning, chat_id, user_id, warned_by, reason)
+    
+    async def get_warnings_count(self, chat_id, user_id):
+        return await self._read(self.db.get_warnings_count, chat_id, user_id)
+    
+    async def remove_warning(self, chat_id, user_id):
+        return await self._write(self.db.remove_warning, chat_id, user_id)
+    
+    async def clear_warnings(self, chat_id, user_id):
+        await self._write(self.db.clear_warnings, chat_id, user_id)
+    
+    # Муты
+    async def add_mute(self, chat_id, user_id, duration_seconds):
+        return await self._write(self.db.add_mute, chat_id, user_id, duration_seconds)
+    
+    async def remove_mute(self, chat_id, user_id):
+        await self._write(self.db.remove_mute, chat_id, user_id)
+    
+    async def is_muted(self, chat_id, user_id):
+        if self.db.mute_index.blocking:
+            return await self._read(self.db.is_muted, chat_id, user_id)
+        return self.db.is_muted(chat_id, user_id)
+    
+    async def expire_mutes(self):
+        return await self._write(self.db.expire_mutes)
+    
+    # Статистика
+    async def update_user_stats(self, chat_id, user_id, username, first_name):
+        # Сброс уходит в поток записи, обработчик сообщения его не ждет
+        if self.db.stats_buffer.add(chat_id, user_id, username, first_name, time.time()) \
+                and self.flushing is None:
+            self.flushing = asyncio.ensure_future(self.flush_user_stats())
+            self.flushing.add_done_callback(self._flushed)
+    
+    def _flushed(self, future):
+        self.flushing = None
+        if not future.cancelled() and future.exception():
+            logger.error("Ошибка сброса статистики: %s", future.exception())
+    
+    async def flush_user_stats(self):
+        return await self._write(self.db.flush_user_stats)
+    
+    async def get_user_stats(self, chat_id, user_id):
+        return await self._read(self.db.get_user_stats, chat_id, user_id)
+    
+    # Обслуживание: каждый шаг - отдельная короткая задача потока записи
+    async def prune_step(self, table, key, condition, cutoffs, archive=None):
+        return await self._write(self.db.prune_step, table, key, condition, cutoffs, archive)
+    
+    async def vacuum_step(self):
+        return await self._write(self.db.vacuum_step)
+    
+    async def analyze(self):
+        return await self._write(self.db.analyze)
+    
+    async def backup(self, path):
+        # Не в потоке записи: шаги копирования чередуются с записями обработчиков
+        return await asyncio.to_thread(self.db.backup, path)
+    
+    async def snapshot(self, path):
+        return await asyncio.to_thread(self.db.snapshot, path)
+    
+    # Отчеты по сводкам: повторные запросы в течение STATS_REPORT_TTL из кэша
+    async def _report(self, key, func, *args):
+        result = self.reports.get(key)
+        if result is None:
+            result = await self._read(func, *args)
+            self.reports[key] = result
+        return result
+    
+    async def get_top_users(self, chat_id, period=None):
+        return await self._report(('top', chat_id, period), self.db.get_top_users, chat_id, period)
+    
+    async def get_chat_activity(self, chat_id, period, since):
+        return await self._report(
+            ('activity', chat_id, period, since), self.db.get_chat_activity, chat_id, period, since
+        )
+
+# ==================== КЭШ АДМИНИСТРАТОРОВ ====================
+ADMIN_STATUSES = ('administrator', 'creator')
+
+class AdminRoster:
+    """Списки администраторов чатов, загружаемые одним get_administrators"""
+    def __init__(self, ttl=ADMIN_CACHE_TTL, maxsize=SETTINGS_CACHE_SIZE):
+        self.rosters = TTLCache(maxsize=maxsize, ttl=ttl)  # chat_id -> (id админов, список ChatMember)
+        self.loading = {}  # chat_id -> asyncio.Lock, чтобы не грузить один чат дважды
+    
+    async def _load(self, chat):
+        roster = self.rosters.get(chat.id)
+        if roster is not None:
+            return roster
+        
+        lock = self.loading.setdefault(chat.id, asyncio.Lock())
+        try:
+            async with lock:
+                roster = self.rosters.get(chat.id)
+                if roster is None:
+                    with metrics.timer('bot_api_seconds', errors='bot_api_errors_total',
+                                       method='get_chat_administrators'):
+                        admins = await chat.get_administrators()
+                    roster = (frozenset(member.user.id for member in admins), admins)
+                    self.rosters[chat.id] = roster
+        finally:
+            if not lock.locked():
+                self.loading.pop(chat.id, None)
+        return roster
+    
+    async def get_admins(self, chat):
+        """Возвращает список администраторов чата (ChatMember)"""
+        return (await self._load(chat))[1]
+    
+    async def is_admin(self, chat, user_id):
+        return user_id in (await self._load(chat))[0]
+    
+    def invalidate(self, chat_id):
+        self.rosters.pop(chat_id)
+
+# ==================== РАССЫЛКИ ====================
+def retry_after_seconds(error):
+    """Сколько секунд ждать по RetryAfter (int или timedelta в разных версиях PTB)"""
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+class RateLimiter:
+    """Асинхронный token bucket: не больше rate операций в секунду"""
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    def try_acquire(self):
+        """Берет токен, если он есть, и возвращает 0; иначе - сколько секунд ждать"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+    
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+async def fan_out(recipients, send, concurrency=FANOUT_CONCURRENCY):
+    """Вызывает send(recipient) для всех получателей параллельно.
+    
+    Одновременно выполняется не больше concurrency отправок. Темп и повторы
+    после RetryAfter - забота outbox, через которую идет send. Возвращает
+    список (получатель, ошибка или None) в порядке recipients.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def deliver(recipient):
+        async with semaphore:
+            try:
+                await send(recipient)
+                return recipient, None
+            except Exception as e:
+                return recipient, e
+    
+    return await asyncio.gather(*(deliver(recipient) for recipient in recipients))
+
+# ==================== ОЧЕРЕДЬ ИСХОДЯЩИХ ЗАПРОСОВ ====================
+# Приоритеты: меньше - срочнее
+PRIORITY_MODERATION = 0  # бан, ограничение, удаление
+PRIORITY_REPLY = 1       # ответы на команды
+PRIORITY_NOTICE = 2      # приветствия и автоматические уведомления
+
+MAX_MESSAGE_LENGTH = 4096
+
+class OutboundRequest:
+    """Запрос к Bot API в очереди; сравнивается по (приоритет, порядок)"""
+    __slots__ = ('priority', 'seq', 'chat_id', 'func', 'args', 'kwargs',
+                 'is_send', 'text', 'merged', 'attempts', 'future')
+    
+    def __init__(self, priority, seq, chat_id, func, args, kwargs, is_send, text, future):
+        self.priority = priority
+        self.seq = seq
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.is_send = is_send
+        self.text = text  # текст уведомления, которое можно склеить с соседними
+        self.merged = 1
+        self.attempts = 0
+        self.future = future
+    
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class Outbox:
+    """Единая очередь исходящих запросов к Bot API.
+    
+    Запросы выполняются по приоритету: модерация раньше ответов, ответы
+    раньше уведомлений. Общий темп ограничен глобальным token bucket,
+    отправка сообщений в группы - еще и bucket'ом каждого чата. RetryAfter
+    откладывает запрос на указанное Telegram время. Когда очередь растет,
+    уведомления в один чат склеиваются в одно сообщение.
+    
+    Уведомления и подтверждения обработчики отправляют через *_nowait и не
+    ждут: иначе исчерпанный лимит чата держал бы обработчик (и очередь
+    обновлений чата) секундами, а соседние уведомления никогда не ждали бы
+    отправки одновременно и не склеивались бы. await нужен, только когда
+    нужен результат запроса.
+    
+    Пока очередь не запущена (start), запросы выполняются сразу.
+    """
+    def __init__(self, workers=OUTBOX_WORKERS, global_rate=OUTBOX_GLOBAL_RATE,
+                 chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST,
+                 merge_backlog=OUTBOX_MERGE_BACKLOG, max_retries=OUTBOX_MAX_RETRIES):
+        self.bot = None
+        self.queue = None
+        self.worker_count = workers
+        self.workers = []
+        self.global_limiter = RateLimiter(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        # Через минуту простоя bucket чата снова полон - хранить его незачем
+        self.chat_limiters = TTLCache(maxsize=SETTINGS_CACHE_SIZE, ttl=120)
+        self.pending_notices = {}  # chat_id -> еще не отправленное уведомление
+        self.merge_backlog = merge_backlog
+        self.max_retries = max_retries
+        self.seq = itertools.count()
+        self.deferred = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.merged = 0
+    
+    def start(self, bot):
+        self.bot = bot
+        self.queue = asyncio.PriorityQueue()
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+    
+    async def stop(self, timeout=5):
+        """Дожидается отправки очереди (не дольше timeout) и останавливает обработчики"""
+        if self.queue is None:
+            return
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь отправки не опустела за %s сек", timeout)
+        
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers.clear()
+        while not self.queue.empty():
+            self.queue.get_nowait().future.cancel()
+            self.queue.task_done()
+        self.queue = None
+    
+    # Постановка в очередь
+    def send(self, chat_id, text, priority=PRIORITY_REPLY, **kwargs):
+        """bot.send_message через очередь"""
+        mergeable = text if priority == PRIORITY_NOTICE and not kwargs else None
+        return self._submit(chat_id, self._send_message,
+                            (chat_id, text), kwargs, priority, True, mergeable)
+    
+    def reply(self, message, text, priority=PRIORITY_REPLY, **kwargs):
+        """message.reply_text через очередь"""
+        mergeable = text if priority == PRIORITY_NOTICE and not kwargs else None
+        return self._submit(message.chat_id, message.reply_text,
+                            (text,), kwargs, priority, True, mergeable)
+    
+    def send_nowait(self, chat_id, text, priority=PRIORITY_REPLY, **kwargs):
+        """send, результата которого обработчик не ждет: ошибка попадет в лог"""
+        return self._detach(self.send(chat_id, text, priority, **kwargs), chat_id)
+    
+    def reply_nowait(self, message, text, priority=PRIORITY_REPLY, **kwargs):
+        """reply, результата которого обработчик не ждет: ошибка попадет в лог"""
+        return self._detach(self.reply(message, text, priority, **kwargs), message.chat_id)
+    
+    def call(self, chat_id, func, *args, priority=PRIORITY_MODERATION, **kwargs):
+        """Любой другой метод API (бан, ограничение, удаление) через очередь"""
+        return self._submit(chat_id, func, args, kwargs, priority, False, None)
+    
+    @staticmethod
+    def _detach(future, chat_id):
+        def log_failure(future):
+            if not future.cancelled() and future.exception() is not None:
+                logger.warning("Не удалось отправить сообщение в чат %s: %s", chat_id, future.exception())
+        future.add_done_callback(log_failure)
+        return future
+    
+    async def _send_message(self, chat_id, text, **kwargs):
+        return await self.bot.send_message(chat_id, text, **kwargs)
+    
+    @staticmethod
+    async def _call(func, args, kwargs):
+        method = func.__name__.lstrip('_')
+        with metrics.timer('bot_api_seconds', errors='bot_api_errors_total', method=method):
+            return await func(*args, **kwargs)
+    
+    def _submit(self, chat_id, func, args, kwargs, priority, is_send, text):
+        if self.queue is None:
+            return asyncio.ensure_future(self._call(func, args, kwargs))
+        
+        if text is not None:
+            pending = self.pending_notices.get(chat_id)
+            if (pending is not None
+                    and self.queue.qsize() + self.deferred >= self.merge_backlog
+                    and len(pending.text) + len(text) + 2 <= MAX_MESSAGE_LENGTH):
+                pending.text += "\n\n" + text
+                pending.merged += 1
+                self.merged += 1
+                return pending.future
+        
+        future = asyncio.get_running_loop().create_future()
+        request = OutboundRequest(priority, next(self.seq), chat_id, func, args, kwargs,
+                                  is_send, text, future)
+        if text is not None:
+            self.pending_notices[chat_id] = request
+        self.queue.put_nowait(request)
+        return future
+    
+    # Выполнение
+    def _chat_limiter(self, chat_id):
+        limiter = self.chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = RateLimiter(self.chat_rate, self.chat_burst)
+        self.chat_limiters[chat_id] = limiter
+        return limiter
+    
+    def _defer(self, request, delay):
+        self.deferred += 1
+        asyncio.get_running_loop().call_later(delay, self._requeue, request)
+    
+    def _requeue(self, request):
+        self.deferred -= 1
+        if self.queue is None:
+            request.future.cancel()
+        else:
+            self.queue.put_nowait(request)
+    
+    async def _worker(self):
+        while True:
+            request = await self.queue.get()
+            try:
+                await self._process(request)
+            except Exception:
+                logger.exception("Ошибка в очереди отправки")
+            finally:
+                self.queue.task_done()
+    
+    async def _process(self, request):
+        if request.future.done():
+            return
+        
+        # Лимит Telegram на группу (~20 сообщений в минуту); личные чаты не ограничиваем
+        if request.is_send and request.chat_id < 0:
+            wait = self._chat_limiter(request.chat_id).try_acquire()
+            if wait:
+                self._defer(request, wait)
+                return
+        
+        if self.pending_notices.get(request.chat_id) is request:
+            del self.pending_notices[request.chat_id]
+        
+        await self.global_limiter.acquire()
+        try:
+            if request.merged > 1:
+                result = await self._call(self._send_message, (request.chat_id, request.text), {})
+            else:
+                result = await self._call(request.func, request.args, request.kwargs)
+        except RetryAfter as e:
+            if request.attempts < self.max_retries:
+                request.attempts += 1
+                self.retried += 1
+                self._defer(request, retry_after_seconds(e))
+                return
+            self.failed += 1
+            request.future.set_exception(e)
+        except Exception as e:
+            self.failed += 1
+            request.future.set_exception(e)
+        else:
+            self.sent += 1
+            request.future.set_result(result)
+    
+    def stats(self):
+        return {
+            'queued': self.queue.qsize() if self.queue else 0,
+            'deferred': self.deferred,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'merged': self.merged,
+        }
+
+# ==================== МАССОВОЕ УДАЛЕНИЕ ====================
+DELETE_BATCH_SIZE = 100  # лимит deleteMessages в Bot API
+
+async def delete_messages_bulk(bot, chat_id, message_ids):
+    """Удаляет сообщения пачками через deleteMessages.
+    
+    Если пачку удалить не удалось, ее сообщения удаляются по одному.
+    Telegram молча пропускает несуществующие и уже удаленные сообщения,
+    поэтому ID успешной пачки только обработаны, а не точно удалены.
+    Возвращает (удалено по одному, обработано пачками, не удалось удалить).
+    """
+    deleted = processed = skipped = 0
+    for start in range(0, len(message_ids), DELETE_BATCH_SIZE):
+        batch = message_ids[start:start + DELETE_BATCH_SIZE]
+        try:
+            await outbox.call(chat_id, bot.delete_messages, chat_id, batch)
+            processed += len(batch)
+            continue
+        except TelegramError as e:
+            logger.info("deleteMessages в чате %s не сработал (%s), удаляем по одному", chat_id, e)
+        
+        for message_id in batch:
+            try:
+                await outbox.call(chat_id, bot.delete_message, chat_id, message_id)
+                deleted += 1
+            except TelegramError:
+                skipped += 1
+    return deleted, processed, skipped
+
+async def delete_later(bot, chat_id, message_ids, delay):
+    """Удаляет служебные сообщения через delay секунд, не занимая обработчик"""
+    await asyncio.sleep(delay)
+    try:
+        await outbox.call(chat_id, bot.delete_messages, chat_id, message_ids, priority=PRIORITY_NOTICE)
+    except TelegramError as e:
+        logger.info("Не удалось удалить служебные сообщения в чате %s: %s", chat_id, e)
+
+# ==================== ВСТУПЛЕНИЯ И РЕЙДЫ ====================
+class JoinTracker:
+    """Частота вступлений по чатам, отложенные приветствия и режим рейда"""
+    def __init__(self, window=JOIN_RATE_WINDOW, raid_duration=RAID_DURATION, timer=time.monotonic):
+        self.window = window
+        self.timer = timer
+        # Без вступлений за окно история чата уже не нужна
+        self.joins = TTLCache(maxsize=SETTINGS_CACHE_SIZE, ttl=window, timer=timer)  # chat_id -> deque времен
+        self.raids = TTLCache(maxsize=SETTINGS_CACHE_SIZE, ttl=raid_duration, timer=timer)
+        self.pending = {}  # chat_id -> имена, которые ждут общего приветствия
+        self.summaries = set()  # задачи отложенных приветствий
+    
+    def record(self, chat_id, count):
+        """Учитывает вступления и возвращает их число за последние window секунд"""
+        now = self.timer()
+        times = self.joins.get(chat_id)
+        if times is None:
+            times = deque()
+        cutoff = now - self.window
+        while times and times[0] <= cutoff:
+            times.popleft()
+        times.extend([now] * count)
+        self.joins[chat_id] = times
+        return len(times)
+    
+    def start_raid(self, chat_id):
+        """Включает (или продлевает) режим рейда. Возвращает True, если он был выключен"""
+        started = chat_id not in self.raids
+        self.raids[chat_id] = True
+        return started
+    
+    def end_raid(self, chat_id):
+        return self.raids.pop(chat_id) is not None
+    
+    def in_raid(self, chat_id):
+        return chat_id in self.raids
+    
+    def queue_welcome(self, chat_id, names):
+        """Откладывает приветствие. Возвращает True, если пора запланировать отправку"""
+        pending = self.pending.get(chat_id)
+        if pending is None:
+            self.pending[chat_id] = list(names)
+            return True
+        pending.extend(names)
+        return False
+    
+    def take_pending(self, chat_id):
+        return self.pending.pop(chat_id, [])
+    
+    def schedule_summary(self, coroutine):
+        """Запускает отложенное приветствие так, чтобы остановка бота его не ждала.
+        
+        Задачи из application.create_task Application.stop() дожидается, а
+        приветствие спит JOIN_SUMMARY_INTERVAL - остановка затянулась бы на
+        столько же, а шард за это время сняли бы, не дав сбросить статистику.
+        """
+        task = asyncio.create_task(coroutine)
+        self.summaries.add(task)
+        task.add_done_callback(self.summaries.discard)
+    
+    async def cancel_summaries(self):
+        """Отменяет отложенные приветствия (при остановке бота)"""
+        tasks = list(self.summaries)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.pending.clear()
+
+async def send_join_summary(chat_id, delay):
+    """Через delay секунд приветствует всех, кто вступил за это время, одним сообщением"""
+    await asyncio.sleep(delay)
+    names = join_tracker.take_pending(chat_id)
+    if not names:
+        return
+    
+    shown = ', '.join(names[:JOIN_SUMMARY_NAMES])
+    if len(names) > JOIN_SUMMARY_NAMES:
+        shown += f" и еще {len(names) - JOIN_SUMMARY_NAMES}"
+    settings = await db.get_chat_settings(chat_id)
+    welcome_text = settings.get('welcome_message', DEFAULT_WELCOME_MESSAGE)
+    try:
+        await outbox.send(chat_id, welcome_text.format(name=shown), priority=PRIORITY_NOTICE)
+        metrics.inc('bot_welcome_summaries_total')
+    except TelegramError as e:
+        logger.info("Не удалось отправить общее приветствие в чат %s: %s", chat_id, e)
+
+# ==================== ПАРАЛЛЕЛЬНАЯ ОБРАБОТКА ОБНОВЛЕНИЙ ====================
+class ChatLaneProcessor(BaseUpdateProcessor):
+    """Обрабатывает разные чаты параллельно, а обновления одного чата - по порядку.
+    
+    Антифлуд и счетчики предупреждений рассчитывают на порядок сообщений
+    внутри чата, поэтому у каждого чата своя очередь (lane). Обновление
+    сначала дожидается своей очереди и только потом занимает обработчик:
+    медленный /clear в одном чате не держит обработчики, нужные другим.
+    Обновления без чата выполняются без очереди.
+    
+    Общий семафор PTB захватывается еще до очереди чата, поэтому он сделан
+    практически безразмерным: иначе ждущие обновления одного занятого чата
+    (рейд, упершийся в лимиты Bot API) заняли бы все места и остановили
+    остальные чаты. Ограничены только обработчики (workers) и глубина
+    очереди каждого чата (max_pending): сверх нее обновления чата отбрасываются.
+    """
+    def __init__(self, workers=UPDATE_WORKERS, max_pending=UPDATE_LANE_MAX_PENDING):
+        super().__init__(sys.maxsize)
+        self.worker_count = workers
+        self.worker_slots = asyncio.Semaphore(workers)
+        self.max_pending = max_pending
+        self.lanes = {}  # chat_id -> [asyncio.Lock, обновлений в очереди и в работе, отброшено]
+        self.running = 0
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
+    
+    async def _run(self, coroutine, queued_at):
+        async with self.worker_slots:
+            metrics.observe('bot_update_wait_seconds', time.perf_counter() - queued_at)
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+    
+    async def do_process_update(self, update, coroutine):
+        queued_at = time.perf_counter()
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await self._run(coroutine, queued_at)
+            return
+        
+        # Место в очереди чата занимается до первого await, т.е. в порядке прихода
+        lane = self.lanes.get(chat.id)
+        if lane is None:
+            lane = self.lanes[chat.id] = [asyncio.Lock(), 0, 0]
+        if lane[1] >= self.max_pending:
+            coroutine.close()
+            metrics.inc('bot_updates_dropped_total')
+            if not lane[2]:
+                logger.warning("Очередь чата %s переполнена (%s обновлений), новые отбрасываются",
+                               chat.id, lane[1])
+            lane[2] += 1
+            return
+        lane[1] += 1
+        try:
+            async with lane[0]:
+                await self._run(coroutine, queued_at)
+        finally:
+            lane[1] -= 1
+            if not lane[1]:
+                del self.lanes[chat.id]
+    
+    def stats(self):
+        depths = [lane[1] for lane in self.lanes.values()]
+        return {
+            'lanes': len(depths),
+            'running': self.running,
+            'waiting': sum(depths) - self.running,
+            'deepest': max(depths, default=0),
+        }
 
 # ==================== ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ====================
 def parse_time(time_str):
@@ -297,7 +2651,12 @@ def create_mute_permissions():
     """Создает права для заглушенного пользователя"""
     return ChatPermissions(
         can_send_messages=False,
-        can_send_media_messages=False,
+        can_send_audios=False,
+        can_send_documents=False,
+        can_send_photos=False,
+        can_send_videos=False,
+        can_send_video_notes=False,
+        can_send_voice_notes=False,
         can_send_polls=False,
         can_send_other_messages=False,
         can_add_web_page_previews=False
@@ -311,56 +2670,277 @@ async def is_admin(update, context, user_id=None):
     chat = update.effective_chat
     
     try:
-        member = await chat.get_member(user_id)
-        return member.status in ['administrator', 'creator']
-    except:
+        return await admin_roster.is_admin(chat, user_id)
+    except Exception as e:
+        logger.warning("Не удалось получить админов чата %s: %s", chat.id, e)
         return False
 
+# ==================== ФИЛЬТРЫ СООБЩЕНИЙ ====================
+class FilterContext:
+    """Сообщение, которое проходит цепочку фильтров, и то, что о нем уже известно"""
+    __slots__ = ('update', 'context', 'chat', 'user', 'message', 'settings')
+    
+    def __init__(self, update, context):
+        self.update = update
+        self.context = context
+        self.chat = update.effective_chat
+        self.user = update.effective_user
+        self.message = update.message
+        self.settings = None  # загружаются перед первым этапом, которому они нужны
+
+class FilterStage:
+    """Этап цепочки фильтров сообщений.
+    
+    cost - примерная цена check() в микросекундах, этапы идут от дешевых к
+    дорогим. settings - поля chat_settings, которые читает этап: настройки
+    чата загружаются перед первым таким этапом. Истинный результат check()
+    - вердикт: выполняется act(), остальные этапы пропускаются.
+    """
+    name = 'stage'
+    cost = 0
+    settings = ()
+    
+    def enabled(self, item):
+        return True
+    
+    async def check(self, item):
+        return None
+    
+    async def act(self, item, verdict):
+        pass
+
+class MuteStage(FilterStage):
+    """Сообщения заглушенных пользователей удаляются"""
+    name = 'mute'
+    cost = 1
+    
+    async def check(self, item):
+        return await db.is_muted(item.chat.id, item.user.id)
+    
+    async def act(self, item, verdict):
+        try:
+            await outbox.call(item.chat.id, item.message.delete)
+        except TelegramError as e:
+            logger.info("Не удалось удалить сообщение заглушенного в чате %s: %s", item.chat.id, e)
+
+class StatsStage(FilterStage):
+    """Учитывает сообщение в статистике; вердикта не выносит"""
+    name = 'stats'
+    cost = 5
+    
+    async def check(self, item):
+        user = item.user
+        await db.update_user_stats(item.chat.id, user.id, user.username, user.first_name)
+        return None
+
+class FloodStage(FilterStage):
+    """Антифлуд: сообщение удаляется, автор заглушается на 5 минут"""
+    name = 'flood'
+    cost = 8
+    settings = ('antiflood_enabled', 'antiflood_count', 'antiflood_seconds')
+    
+    def enabled(self, item):
+        return item.settings.get('antiflood_enabled', True)
+    
+    async def check(self, item):
+        args = (
+            item.chat.id, item.user.id,
+            item.settings.get('antiflood_count', 5),
+            item.settings.get('antiflood_seconds', 10)
+        )
+        if flood_limiter.blocking:
+            return await asyncio.to_thread(flood_limiter.hit, *args)
+        return flood_limiter.hit(*args)
+    
+    async def act(self, item, verdict):
+        chat, user = item.chat, item.user
+        metrics.inc('bot_antiflood_triggers_total')
+        try:
+            await outbox.call(chat.id, item.message.delete)
+            
+            mute_until = datetime.now() + timedelta(minutes=5)
+            await outbox.call(
+                chat.id,
+                chat.restrict_member,
+                user.id,
+                permissions=ChatPermissions(can_send_messages=False),
+                until_date=mute_until
+            )
+            
+            await db.add_mute(chat.id, user.id, 300)
+            
+            outbox.send_nowait(
+                chat.id,
+                f"🚫 {user.full_name} заглушен на 5 минут за флуд.",
+                priority=PRIORITY_NOTICE
+            )
+        except (TelegramError, sqlite3.Error) as e:
+            logger.warning("Антифлуд в чате %s не сработал для %s: %s", chat.id, user.id, e)
+
+class BadWordStage(FilterStage):
+    """Анти-мат: сообщение удаляется, автор получает предупреждение, по лимиту - бан"""
+    name = 'badwords'
+    cost = 30
+    settings = ('bad_words', 'warn_limit')
+    
+    async def check(self, item):
+        matcher = await db.get_bad_word_matcher(item.chat.id)
+        return matcher.search(item.message.text) if matcher else None
+    
+    async def act(self, item, word):
+        chat, user = item.chat, item.user
+        warn_limit = item.settings.get('warn_limit', 3)
+        metrics.inc('bot_badword_triggers_total')
+        try:
+            await outbox.call(chat.id, item.message.delete)
+            warn_count = await db.add_warning(chat.id, user.id, item.context.bot.id, f"Мат: {word}")
+            outbox.send_nowait(
+                chat.id,
+                f"⚠️ {user.full_name}, использование запрещенных слов запрещено!\n"
+                f"Предупреждение {warn_count}/{warn_limit}",
+                priority=PRIORITY_NOTICE
+            )
+            
+            if warn_count >= warn_limit:
+                await outbox.call(chat.id, chat.ban_member, user.id)
+                outbox.send_nowait(
+                    chat.id,
+                    f"🚫 {user.full_name} забанен за превышение лимита предупреждений.",
+                    priority=PRIORITY_NOTICE
+                )
+        except (TelegramError, sqlite3.Error) as e:
+            logger.warning("Анти-мат в чате %s не сработал для %s: %s", chat.id, user.id, e)
+
+class DuplicateStage(FilterStage):
+    """Один и тот же текст с небольшими правками от разных пользователей"""
+    name = 'duplicates'
+    cost = 70
+    
+    def enabled(self, item):
+        return bool(DUPLICATE_THRESHOLD)
+    
+    async def check(self, item):
+        message = item.message
+        similar = duplicate_detector.check(item.chat.id, item.user.id, message.message_id, message.text)
+        if len({entry[2] for entry in similar}) >= DUPLICATE_THRESHOLD:
+            return similar
+        return None
+    
+    async def act(self, item, similar):
+        metrics.inc('bot_duplicate_triggers_total')
+        logger.info("Рассылка в чате %s: %s похожих сообщений", item.chat.id, len(similar))
+        if DUPLICATE_ACTION == 'delete':
+            message_ids = duplicate_detector.take_undeleted(similar)
+            if message_ids:
+                await delete_messages_bulk(item.context.bot, item.chat.id, message_ids)
+
+class FilterPipeline:
+    """Цепочка проверок сообщения: этапы от дешевых к дорогим, до первого вердикта.
+    
+    Новый фильтр - подкласс FilterStage, добавленный через add();
+    handle_messages для этого менять не нужно. Время check() каждого этапа
+    пишется в bot_filter_seconds{stage=...}.
+    """
+    def __init__(self, stages=()):
+        self.stages = []
+        for stage in stages:
+            self.add(stage)
+    
+    def add(self, stage):
+        self.stages.append(stage)
+        self.stages.sort(key=lambda stage: stage.cost)
+    
+    async def run(self, update, context):
+        """Прогоняет сообщение по этапам; возвращает имя этапа с вердиктом или None"""
+        item = FilterContext(update, context)
+        for stage in self.stages:
+            if stage.settings and item.settings is None:
+                item.settings = await db.get_chat_settings(item.chat.id)
+            if not stage.enabled(item):
+                continue
+            
+            started = time.perf_counter()
+            verdict = await stage.check(item)
+            metrics.observe('bot_filter_seconds', time.perf_counter() - started, stage=stage.name)
+            if verdict:
+                metrics.inc('bot_filter_verdicts_total', stage=stage.name)
+                await stage.act(item, verdict)
+                return stage.name
+        return None
+
 # ==================== ИНИЦИАЛИЗАЦИЯ БД И КЭША ====================
-db = Database()
-flood_cache = SimpleCache(maxsize=10000, ttl=60)
+# БД и хранилище состояния открывает init_storage() - в main() и в процессах-
+# шардах. Сам импорт bot.py ничего не создает на диске, поэтому его можно
+# делать из тестов и утилит
+state_backend = None
+database = None
+db = None
+flood_limiter = None
+admin_roster = AdminRoster()
+outbox = Outbox()
+join_tracker = JoinTracker()
+duplicate_detector = DuplicateDetector()
+message_filters = FilterPipeline([MuteStage(), StatsStage(), FloodStage(), BadWordStage(), DuplicateStage()])
+metrics = Metrics()
+
+for state in ('queued', 'deferred'):
+    metrics.gauge('bot_outbox_requests', lambda state=state: outbox.stats()[state], state=state)
+
+def init_storage(path=DB_PATH, warm_up=True):
+    """Открывает БД и хранилище состояния; warm_up - заполнить кэши заранее"""
+    global state_backend, database, db, flood_limiter
+    state_backend = create_state_backend(STATE_BACKEND)
+    database = Database(path, state=state_backend)
+    database.enable_incremental_vacuum()
+    db = AsyncDatabase(database)
+    flood_limiter = state_backend.flood_limiter(maxsize=10000, ttl=60)
+    for field in ('size', 'hits', 'misses', 'evictions'):
+        metrics.gauge('bot_settings_cache', lambda field=field: database.settings_cache.stats()[field], field=field)
+    if warm_up:
+        database.warm_up()
+    return database
 
 # ==================== КОМАНДЫ МОДЕРАЦИИ ====================
 async def ban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Эта команда только для администраторов!")
+        outbox.reply_nowait(update.message, "❌ Эта команда только для администраторов!")
         return
     
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Ответьте на сообщение пользователя, которого хотите забанить!")
+        outbox.reply_nowait(update.message, "❌ Ответьте на сообщение пользователя, которого хотите забанить!")
         return
     
     user_to_ban = update.message.reply_to_message.from_user
     
     try:
-        await update.effective_chat.ban_member(user_to_ban.id)
-        await update.message.reply_text(f"✅ Пользователь {user_to_ban.full_name} забанен.")
+        await outbox.call(update.effective_chat.id, update.effective_chat.ban_member, user_to_ban.id)
+        outbox.reply_nowait(update.message, f"✅ Пользователь {user_to_ban.full_name} забанен.")
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        outbox.reply_nowait(update.message, f"❌ Ошибка: {str(e)}")
 
 async def unban_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Эта команда только для администраторов!")
+        outbox.reply_nowait(update.message, "❌ Эта команда только для администраторов!")
         return
     
     if not context.args:
-        await update.message.reply_text("❌ Укажите ID пользователя!\nПример: /unban 123456789")
+        outbox.reply_nowait(update.message, "❌ Укажите ID пользователя!\nПример: /unban 123456789")
         return
     
     try:
         user_id = int(context.args[0])
-        await update.effective_chat.unban_member(user_id)
-        await update.message.reply_text(f"✅ Пользователь {user_id} разбанен.")
+        await outbox.call(update.effective_chat.id, update.effective_chat.unban_member, user_id)
+        outbox.reply_nowait(update.message, f"✅ Пользователь {user_id} разбанен.")
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        outbox.reply_nowait(update.message, f"❌ Ошибка: {str(e)}")
 
 async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Эта команда только для администраторов!")
+        outbox.reply_nowait(update.message, "❌ Эта команда только для администраторов!")
         return
     
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Ответьте на сообщение пользователя, которого хотите заглушить!")
+        outbox.reply_nowait(update.message, "❌ Ответьте на сообщение пользователя, которого хотите заглушить!")
         return
     
     user_to_mute = update.message.reply_to_message.from_user
@@ -375,143 +2955,162 @@ async def mute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     mute_until = datetime.now() + timedelta(seconds=duration)
     
     try:
-        await update.effective_chat.restrict_member(
+        await outbox.call(
+            update.effective_chat.id,
+            update.effective_chat.restrict_member,
             user_to_mute.id,
             permissions=create_mute_permissions(),
             until_date=mute_until
         )
-        db.add_mute(update.effective_chat.id, user_to_mute.id, duration)
-        await update.message.reply_text(
+        await db.add_mute(update.effective_chat.id, user_to_mute.id, duration)
+        outbox.reply_nowait(
+            update.message,
             f"🔇 Пользователь {user_to_mute.full_name} заглушен на {format_time(duration)}."
         )
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        outbox.reply_nowait(update.message, f"❌ Ошибка: {str(e)}")
 
 async def unmute_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Эта команда только для администраторов!")
+        outbox.reply_nowait(update.message, "❌ Эта команда только для администраторов!")
         return
     
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Ответьте на сообщение пользователя!")
+        outbox.reply_nowait(update.message, "❌ Ответьте на сообщение пользователя!")
         return
     
     user_to_unmute = update.message.reply_to_message.from_user
     
     try:
-        await update.effective_chat.restrict_member(
+        await outbox.call(
+            update.effective_chat.id,
+            update.effective_chat.restrict_member,
             user_to_unmute.id,
             permissions=ChatPermissions(can_send_messages=True)
         )
-        db.remove_mute(update.effective_chat.id, user_to_unmute.id)
-        await update.message.reply_text(f"🔊 Пользователь {user_to_unmute.full_name} разблокирован.")
+        await db.remove_mute(update.effective_chat.id, user_to_unmute.id)
+        outbox.reply_nowait(update.message, f"🔊 Пользователь {user_to_unmute.full_name} разблокирован.")
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        outbox.reply_nowait(update.message, f"❌ Ошибка: {str(e)}")
 
 async def warn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Эта команда только для администраторов!")
+        outbox.reply_nowait(update.message, "❌ Эта команда только для администраторов!")
         return
     
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Ответьте на сообщение пользователя!")
+        outbox.reply_nowait(update.message, "❌ Ответьте на сообщение пользователя!")
         return
     
     user_to_warn = update.message.reply_to_message.from_user
     reason = ' '.join(context.args) if context.args else "Без причины"
     
-    warn_count = db.add_warning(update.effective_chat.id, user_to_warn.id, update.effective_user.id, reason)
-    settings = db.get_chat_settings(update.effective_chat.id)
+    warn_count = await db.add_warning(update.effective_chat.id, user_to_warn.id, update.effective_user.id, reason)
+    settings = await db.get_chat_settings(update.effective_chat.id)
     warn_limit = settings.get('warn_limit', DEFAULT_WARN_LIMIT)
     
     if warn_count >= warn_limit:
         try:
-            await update.effective_chat.ban_member(user_to_warn.id)
-            db.clear_warnings(update.effective_chat.id, user_to_warn.id)
-            await update.message.reply_text(
+            await outbox.call(update.effective_chat.id, update.effective_chat.ban_member, user_to_warn.id)
+            await db.clear_warnings(update.effective_chat.id, user_to_warn.id)
+            outbox.reply_nowait(
+                update.message,
                 f"🚫 {user_to_warn.full_name} получил {warn_count}/{warn_limit} предупреждений и был забанен.\n"
                 f"Причина последнего: {reason}"
             )
         except Exception as e:
-            await update.message.reply_text(f"❌ Ошибка при бане: {str(e)}")
+            outbox.reply_nowait(update.message, f"❌ Ошибка при бане: {str(e)}")
     else:
-        await update.message.reply_text(
+        outbox.reply_nowait(
+            update.message,
             f"⚠️ {user_to_warn.full_name} получил предупреждение ({warn_count}/{warn_limit})\n"
             f"Причина: {reason}"
         )
 
 async def unwarn_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Эта команда только для администраторов!")
+        outbox.reply_nowait(update.message, "❌ Эта команда только для администраторов!")
         return
     
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Ответьте на сообщение пользователя!")
+        outbox.reply_nowait(update.message, "❌ Ответьте на сообщение пользователя!")
         return
     
     user_to_unwarn = update.message.reply_to_message.from_user
-    warn_count = db.remove_warning(update.effective_chat.id, user_to_unwarn.id)
+    warn_count = await db.remove_warning(update.effective_chat.id, user_to_unwarn.id)
     
-    await update.message.reply_text(
+    outbox.reply_nowait(
+        update.message,
         f"✅ С пользователя {user_to_unwarn.full_name} снято предупреждение.\n"
         f"Текущее количество: {warn_count}"
     )
 
 async def clear_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Эта команда только для администраторов!")
+        outbox.reply_nowait(update.message, "❌ Эта команда только для администраторов!")
         return
     
     count = 10
     if context.args:
         try:
             count = int(context.args[0])
-            if count > 100:
-                count = 100
+            if count > CLEAR_MAX_MESSAGES:
+                count = CLEAR_MAX_MESSAGES
         except ValueError:
-            await update.message.reply_text("❌ Укажите число!")
+            outbox.reply_nowait(update.message, "❌ Укажите число!")
             return
     
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Ответьте на сообщение, с которого начать удаление!")
+        outbox.reply_nowait(update.message, "❌ Ответьте на сообщение, с которого начать удаление!")
         return
     
-    deleted = 0
+    chat_id = update.effective_chat.id
+    first_id = update.message.reply_to_message.message_id
+    # Только до команды: дальше - сама команда (ее удалим вместе с отчетом)
+    # и сообщения, написанные уже после нее
+    message_ids = list(range(first_id, min(first_id + count, update.message.message_id)))
+    
     try:
-        message_id = update.message.reply_to_message.message_id
-        for i in range(count):
-            try:
-                await update.effective_chat.delete_message(message_id + i)
-                deleted += 1
-                await asyncio.sleep(0.5)
-            except:
-                pass
-        
-        result_msg = await update.message.reply_text(f"✅ Удалено {deleted} сообщений.")
-        await asyncio.sleep(3)
-        await update.message.delete()
-        await result_msg.delete()
+        deleted, processed, skipped = await delete_messages_bulk(context.bot, chat_id, message_ids)
+        
+        # deleteMessages не говорит, какие из ID существовали
+        if processed:
+            result_text = f"✅ Обработано {deleted + processed} сообщений."
+        else:
+            result_text = f"✅ Удалено {deleted} сообщений."
+        if skipped:
+            result_text += f" Не удалось удалить: {skipped}."
+        result_msg = await outbox.reply(update.message, result_text)
+        context.application.create_task(delete_later(
+            context.bot, chat_id,
+            [update.message.message_id, result_msg.message_id],
+            CLEAR_REPORT_SECONDS
+        ))
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        outbox.reply_nowait(update.message, f"❌ Ошибка: {str(e)}")
 
 async def pin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Эта команда только для администраторов!")
+        outbox.reply_nowait(update.message, "❌ Эта команда только для администраторов!")
         return
     
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Ответьте на сообщение для закрепления!")
+        outbox.reply_nowait(update.message, "❌ Ответьте на сообщение для закрепления!")
         return
     
     try:
-        await update.message.reply_to_message.pin(disable_notification=True)
-        await update.message.reply_text("📌 Сообщение закреплено.")
+        await outbox.call(
+            update.effective_chat.id,
+            update.message.reply_to_message.pin,
+            disable_notification=True
+        )
+        outbox.reply_nowait(update.message, "📌 Сообщение закреплено.")
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        outbox.reply_nowait(update.message, f"❌ Ошибка: {str(e)}")
 
 async def slowmode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Эта команда только для администраторов!")
+        outbox.reply_nowait(update.message, "❌ Эта команда только для администраторов!")
         return
     
     seconds = 5
@@ -523,29 +3122,29 @@ async def slowmode_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if seconds > 300:
                 seconds = 300
         except ValueError:
-            await update.message.reply_text("❌ Укажите число секунд!")
+            outbox.reply_nowait(update.message, "❌ Укажите число секунд!")
             return
     
     try:
-        await update.effective_chat.set_slow_mode_delay(seconds)
+        await outbox.call(update.effective_chat.id, update.effective_chat.set_slow_mode_delay, seconds)
         if seconds > 0:
-            await update.message.reply_text(f"🐢 Медленный режим включен: {seconds} сек между сообщениями.")
+            outbox.reply_nowait(update.message, f"🐢 Медленный режим включен: {seconds} сек между сообщениями.")
         else:
-            await update.message.reply_text("🐢 Медленный режим отключен.")
+            outbox.reply_nowait(update.message, "🐢 Медленный режим отключен.")
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка: {str(e)}")
+        outbox.reply_nowait(update.message, f"❌ Ошибка: {str(e)}")
 
 # ==================== ПОЛЬЗОВАТЕЛЬСКИЕ КОМАНДЫ ====================
 async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.reply_to_message:
-        await update.message.reply_text("❌ Ответьте на сообщение, на которое хотите пожаловаться!")
+        outbox.reply_nowait(update.message, "❌ Ответьте на сообщение, на которое хотите пожаловаться!")
         return
     
     reported_msg = update.message.reply_to_message
     reporter = update.effective_user
     reported_user = reported_msg.from_user
     
-    admins = await update.effective_chat.get_administrators()
+    admins = await admin_roster.get_admins(update.effective_chat)
     
     report_text = (
         f"🚨 ЖАЛОБА в чате {update.effective_chat.title}\n\n"
@@ -555,20 +3154,24 @@ async def report_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"[Перейти к сообщению]({reported_msg.link})"
     )
     
-    sent_count = 0
-    for admin in admins:
-        if not admin.user.is_bot:
-            try:
-                await context.bot.send_message(
-                    admin.user.id,
-                    report_text,
-                    parse_mode=ParseMode.MARKDOWN
-                )
-                sent_count += 1
-            except:
-                pass
+    async def send_report(admin):
+        await outbox.send(
+            admin.user.id,
+            report_text,
+            parse_mode=ParseMode.MARKDOWN
+        )
+    
+    recipients = [admin for admin in admins if not admin.user.is_bot]
+    results = await fan_out(recipients, send_report)
     
-    await update.message.reply_text(f"✅ Жалоба отправлена {sent_count} администраторам.")
+    failed = [(admin, error) for admin, error in results if error is not None]
+    for admin, error in failed:
+        logger.info("Жалоба не доставлена админу %s: %s", admin.user.id, error)
+    
+    reply = f"✅ Жалоба отправлена {len(results) - len(failed)} администраторам."
+    if failed:
+        reply += f"\n⚠️ Не удалось доставить: {len(failed)} (админ не начинал диалог с ботом?)"
+    outbox.reply_nowait(update.message, reply)
 
 async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.reply_to_message:
@@ -576,9 +3179,9 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         target_user = update.effective_user
     
-    stats = db.get_user_stats(update.effective_chat.id, target_user.id)
-    warns = db.get_warnings_count(update.effective_chat.id, target_user.id)
-    is_muted_user = db.is_muted(update.effective_chat.id, target_user.id)
+    stats = await db.get_user_stats(update.effective_chat.id, target_user.id)
+    warns = await db.get_warnings_count(update.effective_chat.id, target_user.id)
+    is_muted_user = await db.is_muted(update.effective_chat.id, target_user.id)
     
     info_text = (
         f"👤 **Информация о пользователе**\n\n"
@@ -595,16 +3198,76 @@ async def info_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"**Сообщений:** {stats['messages_count']}\n"
         )
     
-    await update.message.reply_text(info_text, parse_mode=ParseMode.MARKDOWN)
+    outbox.reply_nowait(update.message, info_text, parse_mode=ParseMode.MARKDOWN)
 
 async def rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    settings = db.get_chat_settings(update.effective_chat.id)
+    settings = await db.get_chat_settings(update.effective_chat.id)
     keyboard = [[InlineKeyboardButton("✅ Принимаю правила", callback_data="accept_rules")]]
-    await update.message.reply_text(
+    outbox.reply_nowait(
+        update.message,
         settings.get('rules', "Правила не установлены."),
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
 
+# Аргумент /top -> период сводки (None - за все время)
+TOP_PERIODS = {
+    'hour': 'hour', 'час': 'hour',
+    'day': 'day', 'день': 'day', 'сегодня': 'day',
+    'week': 'week', 'неделя': 'week',
+    'month': 'month', 'месяц': 'month',
+    'all': None, 'все': None, 'всё': None,
+}
+PERIOD_TITLES = {
+    'hour': 'за этот час',
+    'day': 'за сегодня',
+    'week': 'за эту неделю',
+    'month': 'за этот месяц',
+    None: 'за все время',
+}
+SPARK_BARS = "▁▂▃▄▅▆▇█"
+
+def sparkline(values):
+    """Строка-гистограмма из символов SPARK_BARS"""
+    peak = max(values, default=0)
+    if not peak:
+        return SPARK_BARS[0] * len(values)
+    return ''.join(SPARK_BARS[value * (len(SPARK_BARS) - 1) // peak] for value in values)
+
+async def top_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    arg = context.args[0].lower() if context.args else 'week'
+    if arg not in TOP_PERIODS:
+        outbox.reply_nowait(update.message, "❌ Используйте: /top [hour|day|week|month|all]")
+        return
+    
+    period = TOP_PERIODS[arg]
+    rows = await db.get_top_users(update.effective_chat.id, period)
+    if not rows:
+        outbox.reply_nowait(update.message, f"📊 Сообщений {PERIOD_TITLES[period]} пока нет.")
+        return
+    
+    lines = [f"🏆 Самые активные {PERIOD_TITLES[period]}:", ""]
+    for place, (user_id, username, first_name, messages) in enumerate(rows, 1):
+        lines.append(f"{place}. {first_name or username or user_id} - {messages}")
+    outbox.reply_nowait(update.message, "\n".join(lines))
+
+async def chatstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    now = time.time()
+    since = current_bucket('hour', now) - 23 * 3600
+    hourly, *current = await asyncio.gather(
+        db.get_chat_activity(chat_id, 'hour', since),
+        *(db.get_chat_activity(chat_id, period, current_bucket(period, now)) for period in ROLLUP_PERIODS)
+    )
+    
+    lines = ["📊 Статистика чата", ""]
+    for period, rows in zip(ROLLUP_PERIODS, current):
+        messages, users = rows[-1][1:] if rows else (0, 0)
+        lines.append(f"{PERIOD_TITLES[period].capitalize()}: {messages} сообщений, {users} участников")
+    
+    by_hour = {bucket: messages for bucket, messages, users in hourly}
+    lines += ["", "Последние 24 часа (UTC):", sparkline([by_hour.get(since + i * 3600, 0) for i in range(24)])]
+    outbox.reply_nowait(update.message, "\n".join(lines))
+
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = """
 🤖 **Доступные команды:**
@@ -616,18 +3279,21 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • /unmute - снять заглушение
 • /warn [причина] - выдать предупреждение
 • /unwarn - снять предупреждение
-• /clear [N] - удалить N сообщений
+• /clear [N] - удалить N сообщений (до 1000)
 • /pin - закрепить сообщение
 • /slowmode [сек] - медленный режим
+• /raid [on|off] - режим рейда и пороги вступлений
 
 **👥 Для всех:**
 • /report - пожаловаться на сообщение
 • /info - информация о пользователе
 • /rules - правила чата
+• /top [day|week|month|all] - самые активные
+• /chatstats - статистика чата
 • /menu - меню с кнопками
 • /help - это сообщение
 """
-    await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
+    outbox.reply_nowait(update.message, help_text, parse_mode=ParseMode.MARKDOWN)
 
 async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
@@ -635,7 +3301,8 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         [InlineKeyboardButton("ℹ️ Моя информация", callback_data="menu_info")],
         [InlineKeyboardButton("🆘 Помощь", callback_data="menu_help")],
     ]
-    await update.message.reply_text(
+    outbox.reply_nowait(
+        update.message,
         "📋 **Главное меню**\nВыберите действие:",
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode=ParseMode.MARKDOWN
@@ -644,160 +3311,170 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ==================== НАСТРОЙКИ ====================
 async def set_welcome_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Только для админов!")
+        outbox.reply_nowait(update.message, "❌ Только для админов!")
         return
     
     if not context.args:
-        await update.message.reply_text("❌ Укажите текст приветствия!")
+        outbox.reply_nowait(update.message, "❌ Укажите текст приветствия!")
         return
     
     welcome_text = ' '.join(context.args)
-    db.update_welcome(update.effective_chat.id, welcome_text)
-    await update.message.reply_text("✅ Приветствие обновлено!")
+    await db.update_welcome(update.effective_chat.id, welcome_text)
+    outbox.reply_nowait(update.message, "✅ Приветствие обновлено!")
 
 async def set_rules_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Только для админов!")
+        outbox.reply_nowait(update.message, "❌ Только для админов!")
         return
     
     if not context.args:
-        await update.message.reply_text("❌ Укажите текст правил!")
+        outbox.reply_nowait(update.message, "❌ Укажите текст правил!")
         return
     
     rules_text = ' '.join(context.args)
-    db.update_rules(update.effective_chat.id, rules_text)
-    await update.message.reply_text("✅ Правила обновлены!")
+    await db.update_rules(update.effective_chat.id, rules_text)
+    outbox.reply_nowait(update.message, "✅ Правила обновлены!")
+
+async def raid_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await is_admin(update, context):
+        outbox.reply_nowait(update.message, "❌ Только для админов!")
+        return
+    
+    chat_id = update.effective_chat.id
+    settings = await db.get_chat_settings(chat_id)  # заодно создает строку настроек чата
+    action = context.args[0].lower() if context.args else None
+    
+    if action == 'on':
+        join_tracker.start_raid(chat_id)
+        outbox.reply_nowait(update.message, f"🚨 Режим рейда включен на {format_time(RAID_DURATION)}.")
+        return
+    
+    if action == 'off':
+        join_tracker.end_raid(chat_id)
+        outbox.reply_nowait(update.message, "✅ Режим рейда выключен.")
+        return
+    
+    if len(context.args) == 2:
+        try:
+            burst_threshold, raid_threshold = (int(arg) for arg in context.args)
+        except ValueError:
+            burst_threshold = raid_threshold = -1
+        if burst_threshold < 0 or raid_threshold < 0:
+            outbox.reply_nowait(update.message, "❌ Укажите два числа: /raid <склейка> <рейд>")
+            return
+        await db.update_join_thresholds(chat_id, burst_threshold, raid_threshold)
+        outbox.reply_nowait(update.message, "✅ Пороги вступлений обновлены!")
+        return
+    
+    window = format_time(JOIN_RATE_WINDOW)
+    outbox.reply_nowait(
+        update.message,
+        f"🛡 Режим рейда: {'включен' if join_tracker.in_raid(chat_id) else 'выключен'}\n"
+        f"Общее приветствие: больше {settings.get('join_burst_threshold', DEFAULT_JOIN_BURST_THRESHOLD)} вступлений за {window}\n"
+        f"Рейд: от {settings.get('raid_threshold', DEFAULT_RAID_THRESHOLD)} вступлений за {window}\n\n"
+        f"/raid on, /raid off, /raid <склейка> <рейд> (0 - выключить)"
+    )
 
 async def add_badword_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Только для админов!")
+        outbox.reply_nowait(update.message, "❌ Только для админов!")
         return
     
     if not context.args:
-        await update.message.reply_text("❌ Укажите слово!")
+        outbox.reply_nowait(update.message, "❌ Укажите слово!")
         return
     
     word = context.args[0].lower()
     chat_id = update.effective_chat.id
     
-    bad_words = db.get_bad_words(chat_id)
+    bad_words = await db.get_bad_words(chat_id)
     if word not in bad_words:
         bad_words.append(word)
-        db.update_bad_words(chat_id, bad_words)
-        await update.message.reply_text(f"✅ Слово '{word}' добавлено в черный список!")
+        await db.update_bad_words(chat_id, bad_words)
+        outbox.reply_nowait(update.message, f"✅ Слово '{word}' добавлено в черный список!")
     else:
-        await update.message.reply_text(f"⚠️ Слово '{word}' уже в списке!")
+        outbox.reply_nowait(update.message, f"⚠️ Слово '{word}' уже в списке!")
 
 async def remove_badword_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not await is_admin(update, context):
-        await update.message.reply_text("❌ Только для админов!")
+        outbox.reply_nowait(update.message, "❌ Только для админов!")
         return
     
     if not context.args:
-        await update.message.reply_text("❌ Укажите слово!")
+        outbox.reply_nowait(update.message, "❌ Укажите слово!")
         return
     
     word = context.args[0].lower()
     chat_id = update.effective_chat.id
     
-    bad_words = db.get_bad_words(chat_id)
+    bad_words = await db.get_bad_words(chat_id)
     if word in bad_words:
         bad_words.remove(word)
-        db.update_bad_words(chat_id, bad_words)
-        await update.message.reply_text(f"✅ Слово '{word}' удалено из черного списка!")
+        await db.update_bad_words(chat_id, bad_words)
+        outbox.reply_nowait(update.message, f"✅ Слово '{word}' удалено из черного списка!")
     else:
-        await update.message.reply_text(f"⚠️ Слово '{word}' не найдено в списке!")
+        outbox.reply_nowait(update.message, f"⚠️ Слово '{word}' не найдено в списке!")
 
 # ==================== ОБРАБОТЧИКИ СОБЫТИЙ ====================
 async def handle_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    settings = db.get_chat_settings(update.effective_chat.id)
-    
-    for new_member in update.message.new_chat_members:
-        if new_member.is_bot:
-            continue
-        
-        welcome_text = settings.get('welcome_message', DEFAULT_WELCOME_MESSAGE)
-        welcome_text = welcome_text.format(name=new_member.full_name)
-        await update.message.reply_text(welcome_text)
-
-async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not update.message or not update.message.text:
-        return
-    
     chat = update.effective_chat
-    user = update.effective_user
-    message = update.message
-    
-    if db.is_muted(chat.id, user.id):
-        try:
-            await message.delete()
-        except:
+    members = [member for member in update.message.new_chat_members if not member.is_bot]
+    if not members:
         return
     
-    db.update_user_stats(chat.id, user.id, user.username, user.first_name)
-    settings = db.get_chat_settings(chat.id)
-    
-    # Антифлуд
-    if settings.get('antiflood_enabled', True):
-        cache_key = f"{chat.id}_{user.id}"
-        
-        if cache_key not in flood_cache:
-            flood_cache[cache_key] = []
-        
-        current_time = time.time()
-        flood_cache[cache_key].append(current_time)
-        
-        # Оставляем только сообщения за последние N секунд
-        flood_cache[cache_key] = [
-            t for t in flood_cache[cache_key] 
-            if current_time - t <= settings.get('antiflood_seconds', 10)
+    settings = await db.get_chat_settings(chat.id)
+    joins = join_tracker.record(chat.id, len(members))
+    metrics.inc('bot_joins_total', len(members))
+    
+    # Рейд: новых участников сразу ограничиваем, приветствия не шлем
+    raid_threshold = settings.get('raid_threshold', DEFAULT_RAID_THRESHOLD)
+    raid_started = raid_threshold and joins >= raid_threshold and join_tracker.start_raid(chat.id)
+    if join_tracker.in_raid(chat.id):
+        until = datetime.now() + timedelta(seconds=RAID_RESTRICT_SECONDS)
+        restricts = [
+            outbox.call(chat.id, chat.restrict_member, member.id,
+                        permissions=create_mute_permissions(), until_date=until)
+            for member in members
         ]
-        
-        if len(flood_cache[cache_key]) > settings.get('antiflood_count', 5):
-            try:
-                await message.delete()
-                
-                mute_until = datetime.now() + timedelta(minutes=5)
-                await chat.restrict_member(
-                    user.id,
-                    permissions=ChatPermissions(can_send_messages=False),
-                    until_date=mute_until
-                )
-                
-                db.add_mute(chat.id, user.id, 300)
-                
-                await context.bot.send_message(
-                    chat.id,
-                    f"🚫 {user.full_name} заглушен на 5 минут за флуд."
-                )
-            except:
-                pass
-            return
+        # Ограничения уходят в очередь раньше предупреждения: оно упирается
+        # в лимит сообщений чата, и обработчик его не ждет
+        if raid_started:
+            metrics.inc('bot_raids_total')
+            logger.warning("Режим рейда в чате %s: %s вступлений за %s сек", chat.id, joins, JOIN_RATE_WINDOW)
+            join_tracker.take_pending(chat.id)  # отложенные приветствия, скорее всего, тоже ботам рейда
+            outbox.send_nowait(
+                chat.id,
+                f"🚨 Похоже на рейд: {joins} вступлений за {format_time(JOIN_RATE_WINDOW)}.\n"
+                f"Новые участники ограничиваются на {format_time(RAID_RESTRICT_SECONDS)}. Выключить: /raid off"
+            )
+        results = await asyncio.gather(*restricts, return_exceptions=True)
+        metrics.inc('bot_raid_restricted_total', sum(not isinstance(result, Exception) for result in results))
+        return
     
-    # Анти-мат
-    bad_words = db.get_bad_words(chat.id)
-    if bad_words:
-        text_lower = message.text.lower()
-        for word in bad_words:
-            if word.lower() in text_lower:
-                try:
-                    await message.delete()
-                    warn_count = db.add_warning(chat.id, user.id, context.bot.id, f"Мат: {word}")
-                    await context.bot.send_message(
-                        chat.id,
-                        f"⚠️ {user.full_name}, использование запрещенных слов запрещено!\n"
-                        f"Предупреждение {warn_count}/{settings.get('warn_limit', 3)}"
-                    )
-                    
-                    if warn_count >= settings.get('warn_limit', 3):
-                        await chat.ban_member(user.id)
-                        await context.bot.send_message(
-                            chat.id,
-                            f"🚫 {user.full_name} забанен за превышение лимита предупреждений."
-                        )
-                except:
-                    pass
-                return
+    # Наплыв: копим имена и приветствуем всех разом раз в JOIN_SUMMARY_INTERVAL
+    names = [member.full_name for member in members]
+    burst_threshold = settings.get('join_burst_threshold', DEFAULT_JOIN_BURST_THRESHOLD)
+    if burst_threshold and joins > burst_threshold:
+        if join_tracker.queue_welcome(chat.id, names):
+            join_tracker.schedule_summary(send_join_summary(chat.id, JOIN_SUMMARY_INTERVAL))
+        return
+    
+    welcome_text = settings.get('welcome_message', DEFAULT_WELCOME_MESSAGE)
+    outbox.reply_nowait(update.message, welcome_text.format(name=', '.join(names)), priority=PRIORITY_NOTICE)
+
+async def handle_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not update.message or not update.message.text:
+        return
+    await message_filters.run(update, context)
+
+async def track_admin_changes(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сбрасывает кэш админов, когда кого-то повысили или понизили"""
+    member_update = update.chat_member or update.my_chat_member
+    old_status = member_update.old_chat_member.status
+    new_status = member_update.new_chat_member.status
+    
+    if old_status in ADMIN_STATUSES or new_status in ADMIN_STATUSES:
+        admin_roster.invalidate(member_update.chat.id)
 
 # ==================== ОБРАБОТЧИК КНОПОК ====================
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -810,15 +3487,17 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     if data == "accept_rules":
         await query.edit_message_text("✅ Спасибо! Правила приняты.")
-        if db.is_muted(chat.id, user.id):
-            db.remove_mute(chat.id, user.id)
-            await chat.restrict_member(
+        if await db.is_muted(chat.id, user.id):
+            await db.remove_mute(chat.id, user.id)
+            await outbox.call(
+                chat.id,
+                chat.restrict_member,
                 user.id,
                 permissions=ChatPermissions(can_send_messages=True)
             )
     
     elif data == "menu_rules":
-        settings = db.get_chat_settings(chat.id)
+        settings = await db.get_chat_settings(chat.id)
         keyboard = [[InlineKeyboardButton("✅ Принять", callback_data="accept_rules")]]
         await query.edit_message_text(
             settings.get('rules', "Правила не установлены."),
@@ -826,7 +3505,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
     
     elif data == "menu_info":
-        warns = db.get_warnings_count(chat.id, user.id)
+        warns = await db.get_warnings_count(chat.id, user.id)
         text = f"**Ваша информация:**\n\nID: `{user.id}`\nПредупреждений: {warns}"
         await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN)
     
@@ -835,56 +3514,432 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Используйте /help для списка команд.\nИли просто пишите в чат!"
         )
 
+# ==================== ФОНОВЫЕ ЗАДАЧИ ====================
+background_tasks = []
+
+async def run_periodically(interval, func):
+    """Вызывает func каждые interval секунд, пока задачу не отменят"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            result = func()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logger.exception("Ошибка в фоновой задаче %s", func.__name__)
+
+async def maintain_database(pause=MAINTENANCE_PAUSE):
+    """Чистит БД по RETENTION_POLICIES, затем сжимает файл и обновляет статистику.
+    
+    Каждая пачка - отдельная задача потока записи, а между пачками цикл
+    событий отдыхает pause секунд, так что записи обработчиков встают в
+    очередь не дольше чем за одну пачку.
+    """
+    started = time.monotonic()
+    now = datetime.now()
+    cutoffs = retention_cutoffs(now)
+    archive = RowArchive(MAINTENANCE_ARCHIVE_DIR, now.strftime('%Y%m%d-%H%M%S')) if MAINTENANCE_ARCHIVE_DIR else None
+    removed = {}
+    try:
+        for table, key, condition in RETENTION_POLICIES:
+            if all(cutoffs[name] is None for name in re.findall(r':(\w+)', condition)):
+                continue
+            while True:
+                count = await db.prune_step(table, key, condition, cutoffs, archive)
+                if count:
+                    removed[table] = removed.get(table, 0) + count
+                    metrics.inc('bot_maintenance_deleted_total', count, table=table)
+                if count < MAINTENANCE_BATCH:
+                    break
+                await asyncio.sleep(pause)
+    finally:
+        if archive is not None:
+            archive.close()
+    
+    free_pages = await db.vacuum_step()
+    while free_pages:
+        await asyncio.sleep(pause)
+        left = await db.vacuum_step()
+        if left >= free_pages:
+            break
+        free_pages = left
+    await db.analyze()
+    logger.info("Обслуживание БД за %.1f с, удалено строк: %s", time.monotonic() - started, removed or 0)
+
+async def on_startup(application, shard=0, shards=1):
+    """Запускает фоновые задачи после инициализации бота (или шарда shard из shards)"""
+    outbox.start(application.bot)
+    background_tasks.append(asyncio.create_task(
+        run_periodically(STATS_FLUSH_INTERVAL, db.flush_user_stats)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodically(MUTE_EXPIRY_INTERVAL, db.expire_mutes)
+    ))
+    # БД у шардов общая: чистить, сжимать и копировать ее достаточно одному процессу
+    if shard == 0:
+        background_tasks.append(asyncio.create_task(
+            run_periodically(MAINTENANCE_INTERVAL, maintain_database)
+        ))
+    if shard == 0 and BACKUP_PATH:
+        # Записи других шардов начинали бы копию через backup API заново
+        backup = db.backup if shards == 1 else db.snapshot
+        background_tasks.append(asyncio.create_task(
+            run_periodically(BACKUP_INTERVAL, functools.partial(backup, BACKUP_PATH))
+        ))
+    await start_metrics_server()
+
+async def start_metrics_server():
+    """Поднимает HTTP-сервер метрик, если задан METRICS_PORT"""
+    if METRICS_PORT:
+        server = await asyncio.start_server(serve_metrics, METRICS_HOST, METRICS_PORT)
+        background_tasks.append(asyncio.create_task(server.serve_forever()))
+        logger.info("Метрики: http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+
+async def on_shutdown(application):
+    """Останавливает фоновые задачи и сбрасывает буферы в БД"""
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await join_tracker.cancel_summaries()
+    await outbox.stop()
+    
+    flushed = await db.flush_user_stats()
+    logger.info("Статистика сброшена в БД при остановке: %s записей", flushed)
+    db.close()
+
 # ==================== ЗАПУСК БОТА ====================
-def main():
-    """Запуск бота"""
-    if BOT_TOKEN == "8032712809:AAFcmS1G4xKURy2MZ9izAK8Ne8HXg8EIr8I":
-        print("⚠️  ВНИМАНИЕ: Вы используете токен по умолчанию!")
-        print("⚠️  Замените его на свой токен в строке BOT_TOKEN")
-        print("⚠️  Получите токен у @BotFather в Telegram\n")
-    
-    application = Application.builder().token(BOT_TOKEN).build()
+def allowed_update_types(application):
+    """Типы обновлений, которые нужны зарегистрированным обработчикам.
+    
+    Обработчики сообщений и команд читают только update.message, поэтому
+    edited_message, channel_post и прочее у Telegram не запрашиваем.
+    """
+    types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, ChatMemberHandler):
+                if handler.chat_member_types != ChatMemberHandler.CHAT_MEMBER:
+                    types.add(Update.MY_CHAT_MEMBER)
+                if handler.chat_member_types != ChatMemberHandler.MY_CHAT_MEMBER:
+                    types.add(Update.CHAT_MEMBER)
+            elif isinstance(handler, CallbackQueryHandler):
+                types.add(Update.CALLBACK_QUERY)
+            elif isinstance(handler, (CommandHandler, MessageHandler)):
+                types.add(Update.MESSAGE)
+            else:
+                return Update.ALL_TYPES  # неизвестный обработчик - не рискуем
+    return sorted(types)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Telegram Mod Bot")
+    parser.add_argument('--token', default=BOT_TOKEN, help="токен бота (BOT_TOKEN)")
+    parser.add_argument('--mode', choices=('polling', 'webhook'), default=BOT_MODE,
+                        help="способ получения обновлений (BOT_MODE)")
+    parser.add_argument('--webhook-url', default=WEBHOOK_URL,
+                        help="полный публичный адрес вебхука (WEBHOOK_URL)")
+    parser.add_argument('--webhook-listen', default=WEBHOOK_LISTEN, help="адрес для HTTP-сервера (WEBHOOK_LISTEN)")
+    parser.add_argument('--webhook-port', type=int, default=WEBHOOK_PORT, help="порт HTTP-сервера (WEBHOOK_PORT)")
+    parser.add_argument('--webhook-path', default=WEBHOOK_PATH, help="путь вебхука на сервере (WEBHOOK_PATH)")
+    parser.add_argument('--webhook-secret', default=WEBHOOK_SECRET,
+                        help="секрет для X-Telegram-Bot-Api-Secret-Token (WEBHOOK_SECRET)")
+    parser.add_argument('--webhook-max-connections', type=int, default=WEBHOOK_MAX_CONNECTIONS,
+                        help="сколько запросов Telegram шлет одновременно, 1-100 (WEBHOOK_MAX_CONNECTIONS)")
+    parser.add_argument('--shards', type=int, default=BOT_SHARDS,
+                        help="сколько процессов обрабатывают чаты (BOT_SHARDS)")
+    args = parser.parse_args(argv)
+    
+    if args.mode == 'webhook' and not args.webhook_url:
+        parser.error("для режима webhook нужен --webhook-url или WEBHOOK_URL")
+    if not 1 <= args.webhook_max_connections <= 100:
+        parser.error("--webhook-max-connections должен быть от 1 до 100")
+    if args.shards < 1:
+        parser.error("--shards должен быть не меньше 1")
+    return args
+
+def build_application(token, request=None):
+    """Создает приложение и регистрирует обработчики.
+    
+    request - свой транспорт к Bot API (например, заглушка в нагрузочном тесте).
+    """
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    if UPDATE_WORKERS > 1:
+        processor = ChatLaneProcessor(UPDATE_WORKERS, UPDATE_LANE_MAX_PENDING)
+        builder = builder.concurrent_updates(processor)
+        for state in ('lanes', 'running', 'waiting', 'deepest'):
+            metrics.gauge('bot_update_lanes', lambda state=state: processor.stats()[state], state=state)
+    application = builder.build()
     
     # Команды модерации
-    application.add_handler(CommandHandler("ban", ban_command))
-    application.add_handler(CommandHandler("unban", unban_command))
-    application.add_handler(CommandHandler("mute", mute_command))
-    application.add_handler(CommandHandler("unmute", unmute_command))
-    application.add_handler(CommandHandler("warn", warn_command))
-    application.add_handler(CommandHandler("unwarn", unwarn_command))
-    application.add_handler(CommandHandler("clear", clear_command))
-    application.add_handler(CommandHandler("pin", pin_command))
-    application.add_handler(CommandHandler("slowmode", slowmode_command))
+    application.add_handler(CommandHandler("ban", instrumented(ban_command)))
+    application.add_handler(CommandHandler("unban", instrumented(unban_command)))
+    application.add_handler(CommandHandler("mute", instrumented(mute_command)))
+    application.add_handler(CommandHandler("unmute", instrumented(unmute_command)))
+    application.add_handler(CommandHandler("warn", instrumented(warn_command)))
+    application.add_handler(CommandHandler("unwarn", instrumented(unwarn_command)))
+    application.add_handler(CommandHandler("clear", instrumented(clear_command)))
+    application.add_handler(CommandHandler("pin", instrumented(pin_command)))
+    application.add_handler(CommandHandler("slowmode", instrumented(slowmode_command)))
     
     # Пользовательские команды
-    application.add_handler(CommandHandler("report", report_command))
-    application.add_handler(CommandHandler("info", info_command))
-    application.add_handler(CommandHandler("rules", rules_command))
-    application.add_handler(CommandHandler("help", help_command))
-    application.add_handler(CommandHandler("menu", menu_command))
-    application.add_handler(CommandHandler("start", menu_command))
+    application.add_handler(CommandHandler("report", instrumented(report_command)))
+    application.add_handler(CommandHandler("info", instrumented(info_command)))
+    application.add_handler(CommandHandler("rules", instrumented(rules_command)))
+    application.add_handler(CommandHandler("top", instrumented(top_command)))
+    application.add_handler(CommandHandler("chatstats", instrumented(chatstats_command)))
+    application.add_handler(CommandHandler("help", instrumented(help_command)))
+    application.add_handler(CommandHandler("menu", instrumented(menu_command)))
+    application.add_handler(CommandHandler("start", instrumented(menu_command)))
     
     # Команды настройки
-    application.add_handler(CommandHandler("set_welcome", set_welcome_command))
-    application.add_handler(CommandHandler("set_rules", set_rules_command))
-    application.add_handler(CommandHandler("add_badword", add_badword_command))
-    application.add_handler(CommandHandler("remove_badword", remove_badword_command))
+    application.add_handler(CommandHandler("set_welcome", instrumented(set_welcome_command)))
+    application.add_handler(CommandHandler("set_rules", instrumented(set_rules_command)))
+    application.add_handler(CommandHandler("raid", instrumented(raid_command)))
+    application.add_handler(CommandHandler("add_badword", instrumented(add_badword_command)))
+    application.add_handler(CommandHandler("remove_badword", instrumented(remove_badword_command)))
     
     # Обработчики событий
     application.add_handler(MessageHandler(
         filters.StatusUpdate.NEW_CHAT_MEMBERS, 
-        handle_new_members
+        instrumented(handle_new_members)
     ))
     application.add_handler(MessageHandler(
         filters.TEXT & ~filters.COMMAND,
-        handle_messages
+        instrumented(handle_messages)
+    ))
+    
+    application.add_handler(ChatMemberHandler(
+        instrumented(track_admin_changes),
+        ChatMemberHandler.ANY_CHAT_MEMBER
     ))
     
     # Обработчик кнопок
-    application.add_handler(CallbackQueryHandler(button_callback))
+    application.add_handler(CallbackQueryHandler(instrumented(button_callback)))
+    return application
+
+# ==================== ШАРДИРОВАНИЕ ПО ПРОЦЕССАМ ====================
+def shard_for(update, shards):
+    """Номер шарда для обновления: все обновления одного чата идут в один процесс"""
+    if update.effective_chat is not None:
+        key = update.effective_chat.id
+    elif update.effective_user is not None:
+        key = update.effective_user.id
+    else:
+        key = update.update_id
+    return key % shards
+
+async def serve_shard(token, shard, shards, updates, request=None):
+    """Процесс-шард: обычный набор обработчиков, но обновления приходят из очереди"""
+    global METRICS_PORT
+    if METRICS_PORT:
+        METRICS_PORT += shard + 1
+    # Лимит Telegram на бота общий, поэтому делим его между процессами
+    outbox.global_limiter = RateLimiter(OUTBOX_GLOBAL_RATE / shards)
+    init_storage()
+    
+    application = build_application(token, request)
+    await application.initialize()
+    await on_startup(application, shard, shards)
+    await application.start()
+    logger.info("Шард %s из %s запущен", shard + 1, shards)
+    
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                data = await loop.run_in_executor(None, updates.get, True, 1)
+            except queue.Empty:
+                continue
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(json.loads(data), application.bot))
+    finally:
+        await application.stop()
+        await on_shutdown(application)
+        await application.shutdown()
+
+def run_shard(token, shard, shards, updates, request=None):
+    """Точка входа процесса-шарда"""
+    # Ctrl+C получает вся группа процессов; шарды останавливает front
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_shard(token, shard, shards, updates, request))
+
+class ShardRouter:
+    """Front-процесс: получает обновления и раздает их шардам по chat_id.
+    
+    У каждого шарда свой процесс со своими кэшами, антифлудом и соединением
+    с БД; общая у них только SQLite в режиме WAL. Упавший шард
+    перезапускается с новой очередью (блокировку старой мог унести с собой
+    убитый процесс): обновления, которые он не успел забрать, теряются, как
+    при падении обычного бота, а пришедшие после падения ждут перезапуска.
+    """
+    def __init__(self, token, shards, request=None):
+        self.token = token
+        self.shards = shards
+        self.request = request
+        # spawn, а не fork: дочерний процесс не должен унаследовать соединения SQLite
+        self.context = multiprocessing.get_context('spawn')
+        self.queues = [self.context.Queue() for _ in range(shards)]
+        self.processes = [None] * shards
+        self.stopping = False
+    
+    def _spawn(self, shard):
+        if self.stopping:
+            return
+        process = self.context.Process(
+            target=run_shard, name=f'shard-{shard}',
+            args=(self.token, shard, self.shards, self.queues[shard], self.request)
+        )
+        process.start()
+        self.processes[shard] = process
+        asyncio.get_running_loop().add_reader(process.sentinel, self._on_exit, shard)
+    
+    def _on_exit(self, shard):
+        process = self.processes[shard]
+        loop = asyncio.get_running_loop()
+        loop.remove_reader(process.sentinel)
+        process.join()
+        
+        lost = self.queues[shard]
+        self.queues[shard] = self.context.Queue()
+        lost.cancel_join_thread()
+        lost.close()
+        logger.error("Шард %s завершился с кодом %s, перезапуск через %s сек",
+                     shard + 1, process.exitcode, SHARD_RESTART_DELAY)
+        metrics.inc('bot_shard_restarts_total', shard=shard)
+        loop.call_later(SHARD_RESTART_DELAY, self._spawn, shard)
+    
+    async def route(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        shard = shard_for(update, self.shards)
+        self.queues[shard].put(json.dumps(update.to_dict()))
+        metrics.inc('bot_shard_updates_total', shard=shard)
+    
+    async def start(self, application):
+        for shard in range(self.shards):
+            self._spawn(shard)
+            metrics.gauge('bot_shard_queue', lambda shard=shard: self.queues[shard].qsize(), shard=shard)
+        await start_metrics_server()
+    
+    async def stop(self, application, timeout=30):
+        """Просит шарды доработать очереди и завершиться; зависшие снимает"""
+        self.stopping = True
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        background_tasks.clear()
+        
+        loop = asyncio.get_running_loop()
+        for shard, process in enumerate(self.processes):
+            loop.remove_reader(process.sentinel)
+            self.queues[shard].put(None)
+        for shard, process in enumerate(self.processes):
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.is_alive():
+                logger.warning("Шард %s не остановился за %s сек", shard + 1, timeout)
+                process.terminate()
+                self.queues[shard].cancel_join_thread()
+
+def build_shard_front(token, shards, request=None):
+    """Приложение front-процесса: только получает обновления и передает шардам"""
+    router = ShardRouter(token, shards, request)
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(router.start)
+        .post_shutdown(router.stop)
+    )
+    if request is not None:
+        builder = builder.request(request).get_updates_request(request)
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, router.route))
+    return application
+
+def main(argv=None):
+    """Запуск бота"""
+    args = parse_args(argv)
+    if args.token == DEFAULT_BOT_TOKEN:
+        print("⚠️  ВНИМАНИЕ: Вы используете токен по умолчанию!")
+        print("⚠️  Замените его на свой токен в строке BOT_TOKEN или переменной окружения BOT_TOKEN")
+        print("⚠️  Получите токен у @BotFather в Telegram\n")
     
-    print("🤖 Бот запущен! Нажмите Ctrl+C для остановки.")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application = build_application(args.token)
+    allowed_updates = allowed_update_types(application)
+    logger.info("Запрашиваемые типы обновлений: %s", ", ".join(allowed_updates))
+    if args.shards > 1:
+        # Сама БД front-процессу не нужна, но миграции и перевод в auto_vacuum
+        # делаются один раз до запуска шардов, а не всеми шардами наперегонки
+        prepared = Database(DB_PATH)
+        prepared.enable_incremental_vacuum()
+        prepared.close()
+        application = build_shard_front(args.token, args.shards)
+        logger.info("Чаты распределяются по %s процессам", args.shards)
+    else:
+        init_storage()
+    
+    if args.mode == 'webhook':
+        print(f"🤖 Бот запущен (webhook {args.webhook_url})! Нажмите Ctrl+C для остановки.")
+        application.run_webhook(
+            listen=args.webhook_listen,
+            port=args.webhook_port,
+            url_path=args.webhook_path,
+            webhook_url=args.webhook_url,
+            # Без правильного заголовка X-Telegram-Bot-Api-Secret-Token запрос отклоняется с 403
+            secret_token=args.webhook_secret or secrets.token_urlsafe(32),
+            max_connections=args.webhook_max_connections,
+            allowed_updates=allowed_updates,
+        )
+    else:
+        print("🤖 Бот запущен! Нажмите Ctrl+C для остановки.")
+        application.run_polling(allowed_updates=allowed_updates)
+
+# ==================== ОБСЛУЖИВАНИЕ ИЗ КОМАНДНОЙ СТРОКИ ====================
+MANAGE_COMMANDS = ('backup', 'export', 'import')
+
+def manage(argv=None):
+    """Копия БД и перенос чатов. backup и export можно делать, пока бот
+    работает; import - только при остановленном боте (см. Database.import_chat):
+    
+    python bot.py backup копия.db
+    python bot.py export -1001234567890 чат.ndjson.gz
+    python bot.py import чат.ndjson.gz [--chat-id -1009876543210]
+    """
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--db', default=DB_PATH, help="файл базы данных")
+    parser = argparse.ArgumentParser(prog="bot.py", description="Обслуживание базы данных бота")
+    commands = parser.add_subparsers(dest='command', required=True)
+    backup = commands.add_parser('backup', parents=[common], help="онлайн-копия базы данных")
+    backup.add_argument('path', help="куда сохранить копию")
+    export = commands.add_parser('export', parents=[common], help="выгрузить данные чата в .ndjson.gz")
+    export.add_argument('chat_id', type=int)
+    export.add_argument('path')
+    load = commands.add_parser('import', parents=[common], help="загрузить выгрузку чата (бот должен быть остановлен)")
+    load.add_argument('path')
+    load.add_argument('--chat-id', type=int, help="записать данные в другой чат")
+    args = parser.parse_args(argv)
+    
+    target = Database(args.db)
+    try:
+        if args.command == 'backup':
+            # Бот пишет через свое соединение: backup API отсюда начинал бы копию заново
+            target.snapshot(args.path)
+        elif args.command == 'export':
+            counts = target.export_chat(args.chat_id, args.path)
+            print(f"Выгружено в {args.path}: {counts}")
+        else:
+            counts = target.import_chat(args.path, args.chat_id)
+            print(f"Загружено из {args.path}: {counts}")
+    finally:
+        target.close()
 
 if __name__ == "__main__":
-    main()
+    if sys.argv[1:2] and sys.argv[1] in MANAGE_COMMANDS:
+        manage()
+    else:
+        main()